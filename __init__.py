@@ -1,4 +1,5 @@
-
 import os
 
 ROOTDIR = os.path.dirname(os.path.abspath(__file__))
+# local storage of this library (images usage, archives, ...)
+YADIO_HOME = os.environ.get('YADIO_HOME', os.path.expanduser('~/.yadio'))
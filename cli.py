@@ -0,0 +1,143 @@
+# encoding: utf-8
+
+""" yadio command line interface.
+    Commands are sent to the daemon if it is running, otherwise executed in process.
+    Usage: python -m <package>.cli --help
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from . import ROOTDIR
+from daemon import PLATFORMS_PATH, SOCKET_PATH, Client, Orchestrator, Server
+import utils
+
+
+def get_backend(path=SOCKET_PATH, platforms=PLATFORMS_PATH):
+    """ Returns a daemon Client if a daemon is running, or else an in process Orchestrator
+    :param platforms: the platforms definitions file of the in process Orchestrator
+    """
+    client = Client(path)
+    if client.alive():
+        return client
+    return Orchestrator(platforms)
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def daemon(args):
+    client = Client(args.socket)
+    if args.action == 'run':
+        server = Server(args.socket, Orchestrator(args.platforms))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    elif args.action == 'start':
+        if client.alive():
+            return "daemon already running"
+        package = __package__ or __name__.rsplit('.', 1)[0]
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, '-m', package + '.cli', '--socket', args.socket,
+                              '--platforms', args.platforms, 'daemon', 'run'],
+                             cwd=os.path.dirname(ROOTDIR), stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, preexec_fn=os.setsid)
+        for _ in range(50):
+            if client.alive():
+                return "daemon started"
+            time.sleep(0.1)
+        raise RuntimeError("daemon did not start")
+    elif args.action == 'stop':
+        if not client.alive():
+            return "daemon not running"
+        client.shutdown()
+        return "daemon stopped"
+    else:
+        return client.stats() if client.alive() else "daemon not running"
+
+
+def platform(args):
+    if args.action != 'list' and not args.name:
+        raise ValueError("platform {} requires a platform name".format(args.action))
+    backend = get_backend(args.socket, args.platforms)
+    if args.action == 'create':
+        images = dict(image.split('=', 1) for image in args.images)
+        kwargs = {'network': args.network} if args.network else {}
+        return backend.create_platform(name=args.name, images=images, **kwargs)
+    if args.action == 'drop':
+        return backend.drop_platform(name=args.name)
+    if args.action == 'setup':
+        return backend.call(platform=args.name, method='standard_setup')
+    if args.action == 'teardown':
+        backend.call(platform=args.name, method='reset', args=['rm_container'])
+        return backend.call(platform=args.name, method='teardown_network')
+    return backend.list_platforms()
+
+
+def execute(args):
+    backend = get_backend(args.socket, args.platforms)
+    return backend.execute(platform=args.platform, cmd=' '.join(args.cmd), host=args.host)
+
+
+def call(args):
+    backend = get_backend(args.socket, args.platforms)
+    return backend.call(platform=args.platform, method=args.method, args=[parse_value(arg) for arg in args.args])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='yadio', description="Yet another python docker interface and orchestrator")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="daemon unix socket path")
+    parser.add_argument('--platforms', default=PLATFORMS_PATH,
+                        help="platforms definitions file, used when no daemon is running")
+    subparsers = parser.add_subparsers()
+
+    sub = subparsers.add_parser('daemon', help="manage the daemon")
+    sub.add_argument('action', choices=('start', 'stop', 'status', 'run'))
+    sub.set_defaults(func=daemon)
+
+    sub = subparsers.add_parser('platform', help="define and manage platforms")
+    sub.add_argument('action', choices=('create', 'drop', 'list', 'setup', 'teardown'))
+    sub.add_argument('name', nargs='?')
+    sub.add_argument('images', nargs='*', metavar='host=image')
+    sub.add_argument('--network')
+    sub.set_defaults(func=platform)
+
+    sub = subparsers.add_parser('exec', help="execute a command on the hosts of a platform")
+    sub.add_argument('platform')
+    sub.add_argument('cmd', nargs='+')
+    sub.add_argument('--host')
+    sub.set_defaults(func=execute)
+
+    sub = subparsers.add_parser('call', help="call a PlatformManager method, arguments are json or strings")
+    sub.add_argument('platform')
+    sub.add_argument('method')
+    sub.add_argument('args', nargs='*')
+    sub.set_defaults(func=call)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        result = args.func(args)
+    except Exception as e:
+        sys.stderr.write(utils.red("Error: {}".format(e)) + "\n")
+        return 1
+    if isinstance(result, basestring):
+        print(result)
+    elif result is not None:
+        print(json.dumps(result, indent=2, sort_keys=True, default=list))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# encoding: utf-8
+
+import errno
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+from . import YADIO_HOME
+from docker import PlatformManager
+import docker_basics
+import utils
+
+SOCKET_PATH = os.path.join(YADIO_HOME, 'yadio.sock')
+PLATFORMS_PATH = os.path.join(YADIO_HOME, 'platforms.json')
+
+
+class Orchestrator(object):
+    """ Holds PlatformManager instances, with their definitions saved in a json file,
+        and warm exec sessions on their containers.
+        Its public methods are the RPC API of the daemon, and are used directly by the cli
+        when no daemon is running.
+    """
+
+    def __init__(self, path=PLATFORMS_PATH, query_cache=True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.definitions = {}
+        self.platforms = {}
+        if query_cache:
+            docker_basics.enable_query_cache()
+        try:
+            with open(path) as f:
+                self.definitions = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.path, 'w') as f:
+            json.dump(self.definitions, f, indent=2)
+
+    def get_platform(self, name):
+        with self.lock:
+            if name not in self.platforms:
+                if name not in self.definitions:
+                    raise LookupError("Unknown platform {}".format(name))
+                definition = self.definitions[name]
+                self.platforms[name] = PlatformManager(name, definition['images'], **definition['kwargs'])
+            return self.platforms[name]
+
+    def ping(self):
+        return 'pong'
+
+    def create_platform(self, name, images, **kwargs):
+        """ Defines a platform, see PlatformManager for kwargs
+        """
+        PlatformManager(name, images, **kwargs)
+        with self.lock:
+            self.definitions[name] = {'images': images, 'kwargs': kwargs}
+            self.platforms.pop(name, None)
+            self.save()
+        return name
+
+    def drop_platform(self, name):
+        with self.lock:
+            self.definitions.pop(name, None)
+            self.platforms.pop(name, None)
+            self.save()
+        return name
+
+    def list_platforms(self):
+        return sorted(self.definitions)
+
+    def call(self, platform, method, args=(), kwargs={}):
+        """ Calls a public method of a platform
+        :return: the method result, or None if the method returns the platform itself
+        """
+        if method.startswith('_'):
+            raise AttributeError("Method {} is not public".format(method))
+        platform = self.get_platform(platform)
+        result = getattr(platform, method)(*args, **kwargs)
+        return None if result is platform else result
+
+    def get_session(self, container):
+        with self.lock:
+            session = self.sessions.get(container)
+            if session is None or not session.alive():
+                session = self.sessions[container] = docker_basics.exec_session(container)
+            return session
+
+    def execute(self, platform, cmd, host=None):
+        """ Executes a command on a host, the hosts of a role, or all hosts of a platform, through warm exec sessions
+        :return: stdout, or a dict host: stdout
+        """
+        platform = self.get_platform(platform)
+        containers = platform.select(host)
+
+        def execute(item):
+            k, v = item
+            docker_basics.invalidate_queries(v)
+            return k, self.get_session(v).execute(cmd)[0]
+        results = dict(utils.parallel_map(execute, containers.items()))
+        return results[host] if host in platform.containers else results
+
+    def stats(self):
+        cache = docker_basics.query_cache
+        return {'platforms': sorted(self.platforms), 'sessions': len(self.sessions),
+                'query_cache': cache.stats() if cache else None,
+                'governor': utils.governor.stats() if utils.governor else None}
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.itervalues():
+                session.close()
+            self.sessions = {}
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """ Handles json lines requests {"method": name, "params": {...}},
+        answered by {"result": ...} or {"error": message, "type": exception class name}
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                method = request['method']
+                if method == 'shutdown':
+                    threading.Thread(target=self.server.shutdown).start()
+                    result = None
+                elif method.startswith('_') or not hasattr(self.server.orchestrator, method):
+                    raise AttributeError("Unknown method {}".format(method))
+                else:
+                    result = getattr(self.server.orchestrator, method)(**request.get('params', {}))
+                response = {'result': result}
+            except Exception as e:
+                response = {'error': str(e), 'type': e.__class__.__name__}
+            self.wfile.write(json.dumps(response, default=list) + '\n')
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, orchestrator=None):
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if os.path.exists(path):
+            if Client(path).alive():
+                raise RuntimeError("A daemon is already listening on {}".format(path))
+            os.remove(path)
+        self.path = path
+        self.orchestrator = orchestrator or Orchestrator()
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path, RequestHandler)
+
+    def server_close(self):
+        SocketServer.ThreadingUnixStreamServer.server_close(self)
+        self.orchestrator.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Client(object):
+    """ Client of the daemon, exposing its RPC methods as python methods
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+
+    def request(self, method, params=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            f = sock.makefile('rw')
+            f.write(json.dumps({'method': method, 'params': params or {}}) + '\n')
+            f.flush()
+            line = f.readline()
+        finally:
+            sock.close()
+        if not line:
+            raise RuntimeError("No response from daemon on {}".format(self.path))
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError("{}: {}".format(response['type'], response['error']))
+        return response['result']
+
+    def alive(self):
+        try:
+            return self.request('ping') == 'pong'
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EPIPE, errno.ECONNRESET):
+                return False
+            raise
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda **params: self.request(name, params)
@@ -1,5 +1,11 @@
 # encoding: utf-8
 
+from contextlib import contextmanager
+import hashlib
+import json
+import tempfile
+import threading
+
 from docker_basics import *
 import utils
 
@@ -13,28 +19,122 @@ class PlatformManager(utils.Sequencer):
     """
 
     def __init__(self, platform, images, common_parameters='', parameters={},
-                 network=None, user=None, timeout=1):
+                 network=None, networks={}, user=None, timeout=1, namespace=None, image_archive=None,
+                 common_tmpfs={}, tmpfs={}, package_cache=None, replicas={}, lazy=False):
         """
         :param platform: string
         :param images: dictionary/pair iterable of container-name:image
         :param parameters: dictionary/pair iterable of container-name:iterable of strings
+        :param network: the platform network, all containers are created on it (defaults to platform)
+        :param networks: dictionary container-name:iterable of additional networks names
+        :param namespace: isolation namespace, appended to containers, networks and deployed images names,
+               and set as a label on them (defaults to docker_basics.default_namespace()).
+               The base images built by build_images are shared by all namespaces, and are not labelled.
+        :param image_archive: an optional image_cache.ImageArchive, used to load images instead of building them
+        :param common_tmpfs: dictionary path:size of directories mounted as tmpfs on all containers
+               (see docker_basics.docker_run)
+        :param tmpfs: dictionary container-name:dictionary path:size of directories mounted as tmpfs
+        :param package_cache: an optional package_cache.PackageCache, the apt and pip proxy of the images builds
+        :param replicas: dictionary container-name:count of replicated hosts, a replicated host (or role)
+               has count containers, named host-1..host-count (see scale).
+               The other settings of the replicas are the ones of their role.
+        :param lazy: if True, run_containers only registers the containers, each host is created or started
+               when first targeted (docker_exec, put_data, get_hosts, ...), see materialize
         """
         self.images_rootdir = ROOTDIR
         self.platform_name = platform
         self.platform = self
-        self.network = network or platform
-        self.images = images
+        self.namespace = default_namespace() if namespace is None else namespace
+        self.labels = {NAMESPACE_LABEL: self.namespace} if self.namespace else {}
+        self.network = self.namespaced(network or platform)
+        self.role_images = dict(images)
+        self.role_networks = {k: [self.network] + [self.namespaced(n) for n in networks.get(k, ())
+                                                   if self.namespaced(n) != self.network]
+                              for k in self.role_images}
+        self.networks_names = set(n for v in self.role_networks.itervalues() for n in v)
+        self.role_tmpfs = {k: dict(common_tmpfs, **tmpfs.get(k, {})) for k in self.role_images}
         common_parameters += ' '
-        self.parameters = {k: common_parameters for k in images}
-        for k in images:
-            if k in parameters:
-                self.parameters[k] += parameters[k]
+        self.role_parameters = {k: common_parameters + parameters.get(k, '') for k in self.role_images}
         self.user = user
         self.timeout = timeout
-        self.containers = {k: '-'.join((v, self.platform_name, k)) for k, v in images.iteritems()}
-        self.images_names = set(images.values())
-        self.containers_names = self.containers.values()
+        self.image_archive = image_archive
+        self.package_cache = package_cache
+        self.replicas = dict(replicas)
+        self.lazy = lazy
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.images_names = set(self.role_images.values())
         self.managers = {}
+        self.roles = {}
+        self.images, self.host_networks, self.tmpfs, self.parameters, self.containers = {}, {}, {}, {}, {}
+        self.containers_names = []
+        for role in self.role_images:
+            self.roles[role] = [role] if role not in self.replicas else self.replicas_names(role, 1, replicas[role])
+            for host in self.roles[role]:
+                self.register_host(role, host)
+
+    def replicas_names(self, role, first, last):
+        return ['{}-{}'.format(role, i) for i in range(first, last + 1)]
+
+    def register_host(self, role, host):
+        """ Defines the settings and container of a host of a role
+        """
+        self.images[host] = self.role_images[role]
+        self.host_networks[host] = self.role_networks[role]
+        self.tmpfs[host] = self.role_tmpfs[role]
+        self.parameters[host] = self.role_parameters[role]
+        self.containers[host] = self.namespaced('-'.join((self.images[host], self.platform_name, host)))
+        self.containers_names = self.containers.values()
+
+    def unregister_host(self, host):
+        self.pending.discard(host)
+        for settings in (self.images, self.host_networks, self.tmpfs, self.parameters, self.containers):
+            del settings[host]
+        self.containers_names = self.containers.values()
+
+    def select(self, host=None):
+        """ Returns the dict host:container of the targeted hosts, materialized first in lazy mode
+        :param host: a host, a replicated role (all its replicas), or None (all hosts)
+        """
+        if host is None:
+            containers = dict(self.containers)
+        elif host in self.containers:
+            containers = {host: self.containers[host]}
+        elif host in self.roles:
+            containers = {k: self.containers[k] for k in self.roles[host]}
+        else:
+            raise LookupError("host or role {} not found".format(host))
+        if self.pending:
+            self.start_pending(containers)
+        return containers
+
+    def container(self, host):
+        """ Returns the container of a host, materialized first in lazy mode
+        """
+        return self.select(host)[host]
+
+    def materialize(self, host=None):
+        """ Creates or starts eagerly the registered containers of a lazy platform
+        :param host: a host, a role, or None (all hosts)
+        """
+        self.select(host)
+        return self
+
+    def start_pending(self, hosts):
+        with self.pending_lock:
+            hosts = self.pending.intersection(hosts)
+            if hosts:
+                self.start_hosts(hosts)
+                self.pending.difference_update(hosts)
+
+    def namespaced(self, name):
+        return namespaced(name, self.namespace)
+
+    def cleanup_namespace(self):
+        """ Removes everything created in the platform namespace, see docker_basics.namespace_cleanup
+        """
+        namespace_cleanup(self.namespace)
+        return self
 
     def register_manager(self, name, manager):
         self.managers[name] = manager
@@ -59,8 +159,7 @@ class PlatformManager(utils.Sequencer):
     def standard_setup(self):
         self.build_images()
         self.setup_network()
-        self.run_containers('rm_container')
-        return self.connect_network()
+        return self.run_containers('rm_container')
 
     def reset(self, reset='rm_image'):
         """ Resets a platform
@@ -84,11 +183,17 @@ class PlatformManager(utils.Sequencer):
 
     def build_images(self, reset=None):
         self.reset(reset)
-        existing = self.get_real_images()
-        for image in self.images_names:
-            if image not in existing:
-                print(utils.yellow("Build image {}".format(image)))
-                docker_build(image)
+        missing = self.images_names.difference(self.get_real_images())
+        if self.image_archive:
+            missing = [image for image in missing if not self.image_archive.load(image)]
+        # the package cache is only started for the images really built
+        options = self.package_cache.build_options() if missing and self.package_cache else {}
+        for image in missing:
+            print(utils.yellow("Build image {}".format(image)))
+            if self.image_archive:
+                self.image_archive.build(image, **options)
+            else:
+                docker_build(image, **options)
         return self
 
     def images_exist(self):
@@ -96,16 +201,61 @@ class PlatformManager(utils.Sequencer):
 
     def run_containers(self, reset=None):
         self.reset(reset)
-        running = self.get_real_containers()
-        existing = self.get_real_containers(True)
-        for k, v in self.images.iteritems():
+        if self.lazy:
+            self.pending.update(self.containers)
+            return self
+        return self.start_hosts(self.containers)
+
+    def start_hosts(self, hosts):
+        """ Creates or starts the containers of hosts which are not running, concurrently
+        """
+        containers = [self.containers[k] for k in hosts]
+        running = get_containers(containers, all=False)
+        existing = get_containers(containers)
+
+        def start(k):
             container = self.containers[k]
-            if container in running:
-                continue
             if container in existing:
                 docker_start(container)
             else:
-                docker_run(v, container, container, self.parameters[k])
+                docker_run(self.images[k], container, container, self.parameters[k], self.network, self.labels,
+                           self.tmpfs[k])
+                for network in self.host_networks[k][1:]:
+                    network_connect(network, container)
+        utils.parallel_map(start, [k for k in hosts if self.containers[k] not in running])
+        return self
+
+    def scale(self, role, count):
+        """ Sets the number of replicas of a replicated role:
+            only the missing replicas are created, or the extra ones stopped and deleted.
+            Raises a RuntimeError if some containers could not be deleted, their hosts are kept.
+        """
+        if role not in self.replicas:
+            raise LookupError("role {} is not replicated".format(role))
+        hosts = self.roles[role]
+        if count < len(hosts):
+            removed = [k for k in hosts[count:] if k not in self.pending]
+            utils.parallel_map(lambda k: container_stop(self.containers[k]), removed)
+            utils.parallel_map(lambda k: container_delete(self.containers[k]), removed)
+            remaining = get_containers([self.containers[k] for k in removed])
+            failed = [k for k in removed if self.containers[k] in remaining]
+            self.roles[role] = hosts[:count] + failed
+            for host in hosts[count:]:
+                if host not in failed:
+                    self.unregister_host(host)
+            if failed:
+                self.replicas[role] = len(self.roles[role])
+                raise RuntimeError("Could not delete the containers of {}".format(', '.join(failed)))
+        elif count > len(hosts):
+            added = self.replicas_names(role, len(hosts) + 1, count)
+            self.roles[role] = hosts + added
+            for host in added:
+                self.register_host(role, host)
+            if self.lazy:
+                self.pending.update(added)
+            else:
+                self.start_hosts(added)
+        self.replicas[role] = count
         return self
 
     def get_real_images(self):
@@ -134,18 +284,26 @@ class PlatformManager(utils.Sequencer):
         return self
 
     def setup_network(self):
-        if not self.network in get_networks(self.network):
-            docker_network(self.network)
+        """ Creates the missing platform networks, queried all at once
+        """
+        missing = self.networks_names.difference(get_networks(self.networks_names))
+        utils.parallel_map(lambda network: docker_network(network, labels=self.labels), missing)
         return self
 
     def connect_network(self):
-        for cont in self.containers_names:
-            network_connect(self.network, cont)
+        """ Connects the containers to the networks they are not connected to yet.
+            Not needed after run_containers, as containers are created on their networks.
+        """
+        for k, v in self.select().iteritems():
+            connected = get_container_networks(v)
+            for network in self.host_networks[k]:
+                if network not in connected:
+                    network_connect(network, v)
         return self
 
     def teardown_network(self):
-        if self.network in get_networks(self.network):
-            docker_network(self.network, 'remove')
+        for network in get_networks(self.networks_names):
+            docker_network(network, 'remove')
         return self
 
     def __enter__(self):
@@ -154,50 +312,103 @@ class PlatformManager(utils.Sequencer):
     def __exit__(self, *args):
         self.run_sequence(getattr(self, 'post', ()))
 
-    def get_hosts(self, raises=False):
+    def get_hosts(self, raises=False, host=None):
         """ Returns the dict(host, ip) of containers actually running, or raises
            an exception if the number of running containers differs from the number
            of defined containers.
+        :param host: optional host or role, see select
         """
-        self.hosts_ips = {k: get_container_ip(v) for k, v in self.containers.iteritems()}
+        containers = self.select(host)
+        self.hosts_ips = {k: get_container_ip(v, network=self.network) for k, v in containers.iteritems()}
         if raises:
             if not all(self.hosts_ips.values()):
-                expected = len(self.containers)
+                expected = len(containers)
                 found = len([x for x in self.hosts_ips.itervalues() if x])
                 raise RuntimeError("Expecting {} running containers, found {}".format(expected, found))
         return self.hosts_ips
 
     def docker_exec(self, cmd, host=None, status_only=False):
-        if host:
-            return docker_exec(cmd, self.containers[host], status_only=status_only)
-        return {k: docker_exec(cmd, v, status_only=status_only) for k, v in self.containers.iteritems()}
+        """ Executes a command on a host, or concurrently on the hosts of a role or on all hosts (see select)
+        :return: the result of docker_basics.docker_exec, or a dict host:result
+        """
+        if host in self.containers:
+            return docker_exec(cmd, self.container(host), status_only=status_only)
+        return dict(utils.parallel_map(lambda item: (item[0], docker_exec(cmd, item[1], status_only=status_only)),
+                                       self.select(host).items()))
+
+    @contextmanager
+    def batch(self, host=None, user=None, raises=False, stop_on_error=False):
+        """ Context manager yielding a docker_basics.Batch, executed at exit on one host,
+            or concurrently on the hosts of a role or on all hosts (see select).
+            Results are available afterwards in the Batch 'results' attribute: a list of BatchResult,
+            or a dict host: list of BatchResult if several hosts are targeted.
+        """
+        b = Batch(user, stop_on_error)
+        yield b
+        if host in self.containers:
+            b.results = b.execute(self.container(host), raises)
+        else:
+            b.results = dict(utils.parallel_map(lambda item: (item[0], b.execute(item[1], raises)),
+                                                self.select(host).items()))
 
     def create_user(self, user, groups=(), home=None, shell=None, host=None):
-        containers = [self.containers[host]] if host else self.containers.itervalues()
-        for container in containers:
+        for container in self.select(host).itervalues():
             create_user(user, container, groups, home, shell)
         return self
 
     def put_data(self, data, dest, host=None, append=False):
-        containers = [self.containers[host]] if host else self.containers.itervalues()
+        """ Copy data to a file on one or all hosts, see docker_basics.put_data.
+            When copying to several hosts, a file-like data is read again from its current position
+            for each host, and an iterable data is first spooled to a local temporary file.
+        """
+        containers = self.select(host).values()
+        if isinstance(data, basestring) or len(containers) < 2:
+            for container in containers:
+                put_data(data, dest, container, append=append, user=self.user)
+            return self
+        if not hasattr(data, 'seek'):
+            spool = tempfile.TemporaryFile()
+            for chunk in utils.iter_chunks(data):
+                spool.write(chunk)
+            spool.seek(0)
+            data = spool
+        start = data.tell()
         for container in containers:
+            data.seek(start)
             put_data(data, dest, container, append=append, user=self.user)
         return self
 
     def put_file(self, source, dest, host=None):
-        containers = [self.containers[host]] if host else self.containers.itervalues()
-        for container in containers:
+        for container in self.select(host).itervalues():
             put_file(source, dest, container, user=self.user)
         return self
 
-    def get_data(self, source, host=None):
-        if host:
-            return get_data(source, self.containers[host])
-        return {k: get_data(source, v) for k, v in self.containers.iteritems()}
+    def get_data(self, source, host=None, dest=None, offset=0, length=None, tail=None):
+        """ Reads a file, or a byte range of a file, on one host, or concurrently on several hosts (see select).
+        :param dest: if not None, the data is streamed to local files instead of being returned.
+               When reading from several hosts, dest is either a format string with a '{host}' field,
+               or a directory where one file per host is written.
+        :return: the data or the number of bytes written, or a dict of these per host
+        """
+        if host in self.containers:
+            return get_data(source, self.container(host), dest, offset, length, tail)
+
+        def get(item):
+            k, v = item
+            if dest is None:
+                path = None
+            elif '{host}' in dest:
+                path = dest.format(host=k)
+            else:
+                path = os.path.join(dest, k)
+            return k, get_data(source, v, path, offset, length, tail)
+        return dict(utils.parallel_map(get, self.select(host).items()))
+
+    def iter_data(self, source, host, offset=0, length=None, tail=None, chunk_size=utils.CHUNK_SIZE):
+        return iter_data(source, self.container(host), offset, length, tail, chunk_size)
 
     def path_exists(self, path, host=None, negate=False):
-        containers = [self.containers[host]] if host else self.containers.itervalues()
-        for container in containers:
+        for container in self.select(host).itervalues():
             if negate:
                 if not path_exists(path, container):
                     continue
@@ -210,20 +421,34 @@ class PlatformManager(utils.Sequencer):
         return True
 
     def get_version(self, app, host=None):
-        if host:
-            return get_version(app, self.containers[host])
-        return {k: get_version(app, v) for k, v in self.containers.iteritems()}
-
-    def commit_containers(self, images, stop=True):
+        if host in self.containers:
+            return get_version(app, self.container(host))
+        return {k: get_version(app, v) for k, v in self.select(host).iteritems()}
+
+    def commit_containers(self, images, stop=True, labels=None, persist_tmpfs=False, services=()):
+        """ Commits the containers to images
+        :param images: dictionary container-name:image
+        :param labels: optional dictionary of labels set on the images, in addition to the namespace label
+        :param persist_tmpfs: if True, the content of the tmpfs directories is archived in the images,
+               and restored in the tmpfs of the containers created from them by run_containers
+        :param services: services stopped while archiving the tmpfs directories (see docker_basics.tmpfs_save)
+        """
+        self.materialize()
+        if persist_tmpfs:
+            utils.parallel_map(lambda k: tmpfs_save(self.containers[k], self.tmpfs[k], services),
+                               [k for k in self.containers if self.tmpfs[k]])
         if stop:
             self.containers_stop()
+        labels = dict(self.labels, **(labels or {}))
         for k, v in self.containers.iteritems():
             print(utils.yellow("commit {} to {}".format(v, images[k])))
-            docker_commit(v, images[k])
+            # the containers with tmpfs run the init script of docker_run, the images get the original command
+            command = get_image_command(self.images[k]) if self.tmpfs[k] else None
+            docker_commit(v, images[k], labels, command)
         return self
 
-    def wait_process(self, proc, raises=True):
-        for container in self.containers.itervalues():
+    def wait_process(self, proc, raises=True, host=None):
+        for container in self.select(host).itervalues():
             if not wait_running_process(proc, container, timeout=self.timeout):
                 if raises:
                     raise RuntimeError("Container {} has no running '{}'".format(container, proc))
@@ -231,20 +456,30 @@ class PlatformManager(utils.Sequencer):
         return True
 
     def get_processes(self, filter=None, host=None):
-        if host:
-            return get_processes(self.containers[host], filter)
-        return {k: get_processes(v, filter) for k, v in self.containers.iteritems()}
+        if host in self.containers:
+            return get_processes(self.container(host), filter)
+        return {k: get_processes(v, filter) for k, v in self.select(host).iteritems()}
+
+    def process_snapshot(self, host=None, filter=None):
+        """ Takes a structured snapshot of the processes of one host, or of several hosts concurrently,
+            see docker_basics.get_process_table and diff_processes
+        :return: a list of Process, or a dict host: list of Process
+        """
+        if host in self.containers:
+            return get_process_table(self.container(host), filter)
+        return dict(utils.parallel_map(lambda item: (item[0], get_process_table(item[1], filter)),
+                                       self.select(host).items()))
 
     def start_services(self, *args, **kwargs):
         """ start services on the platform
         :param args: sequence of services to start on all hosts.
-        :param kwargs: key=host, value=sequence of services, or
-                       key=service, value=sequence of hosts.
+        :param kwargs: key=host or role, value=sequence of services, or
+                       key=service, value=sequence of hosts or roles.
         """
         wait_process = kwargs.pop('wait_process', None)
         for service in args:
             self.docker_exec('service {} start'.format(service))
-        hosts_keys = set(kwargs).issubset(set(self.images))
+        hosts_keys = set(kwargs).issubset(set(self.containers).union(self.roles))
         for k, v in kwargs.iteritems():
             for x in v:
                 if hosts_keys:
@@ -264,17 +499,22 @@ class PlatformManager(utils.Sequencer):
             and that an authorized_keys file is set with a rsa plubilc key,
             all conditions met by images provided in this project.
         """
-        if host:
-            return utils.ssh(cmd, get_container_ip(self.containers[host]), self.user or 'root')
-        return {k: utils.ssh(cmd, get_container_ip(v), self.user or 'root') for k, v in self.containers.iteritems()}
+        if host in self.containers:
+            container = self.container(host)
+            invalidate_queries(container)
+            return utils.ssh(cmd, get_container_ip(container), self.user or 'root')
+        containers = self.select(host)
+        for container in containers.itervalues():
+            invalidate_queries(container)
+        return {k: utils.ssh(cmd, get_container_ip(v), self.user or 'root') for k, v in containers.iteritems()}
 
     def scp(self, source, dest, host=None):
         """ this method requires that an ssh daemon is running on the target
             and that an authorized_keys file is set with a rsa plubilc key,
             all conditions met by images provided in this project.
         """
-        containers = [self.containers[host]] if host else self.containers.itervalues()
-        for container in containers:
+        for container in self.select(host).itervalues():
+            invalidate_queries(container)
             utils.scp(source, dest, get_container_ip(container), self.user or 'root')
         return self
 
@@ -283,29 +523,67 @@ class DeployedPlatformManager(PlatformManager):
     """ Class that manages the deployed platform, essentially through specific images and
         containers names, plus a setup function constructing these images and containers.
         Here the subclass PlatformManager is used as a mixin (constructor not called).
+        Deployed images are labelled with a fingerprint of the deployment inputs, and are
+        deployed again only when this fingerprint changes.
     """
 
-    def __init__(self, platform, manager, **kwargs):
+    fingerprint_label = 'yadio.fingerprint'
+
+    def __init__(self, platform, manager, inputs=None, **kwargs):
+        """
+        :param platform: the PlatformManager of the platform to deploy
+        :param inputs: optional json serializable deployment inputs, part of the images fingerprint
+        :param kwargs: settings such as 'distri', or 'persist_tmpfs' to keep the content of the platform
+               tmpfs directories in the deployed images (see commit_containers)
+        """
         self.platform = platform
         self.manager = manager
+        self.inputs = inputs
         self.__dict__.update(kwargs)
         self.platform_name = platform.platform_name
         self.parameters = platform.parameters
         self.user = platform.user
         self.timeout = platform.timeout
-        self.images = {k: '-'.join((v, self.platform_name, k)) for k, v in platform.images.iteritems()}
+        self.namespace = platform.namespace
+        self.labels = platform.labels
+        self.network = platform.network
+        self.host_networks = platform.host_networks
+        self.roles = platform.roles
+        self.replicas = {}
+        self.lazy = platform.lazy
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.tmpfs = platform.tmpfs
+        self.networks_names = platform.networks_names
+        self.images = {k: self.namespaced('-'.join((v, self.platform_name, k)))
+                       for k, v in platform.images.iteritems()}
         self.containers = {k: '-'.join((v, 'deployed')) for k, v in self.images.iteritems()}
         self.images_names = set(self.images.values())
         self.containers_names = self.containers.values()
 
+    def fingerprint(self):
+        """ A hash of the base images ids, the distri setting and the deployment inputs
+        """
+        ids = get_images_ids(self.platform.images_names)
+        sha = hashlib.sha256(json.dumps({'images': ids, 'distri': getattr(self, 'distri', None),
+                                         'inputs': self.inputs}, sort_keys=True, default=str))
+        return sha.hexdigest()
+
+    def images_up_to_date(self, fingerprint):
+        labels = get_images_label(self.images_names, self.fingerprint_label)
+        return set(labels) == self.images_names and set(labels.itervalues()) == {fingerprint}
+
     def setup(self, reset=None):
         fabric = self.platform.get_manager('fabric')
         self.reset(reset)
-        if not self.images_exist():
+        self.platform.build_images()
+        fingerprint = self.fingerprint()
+        if not self.images_up_to_date(fingerprint):
             self.platform.setup('rm_container')
             fabric.set_platform(distrib=self.distri)
             fabric.deploy_from_scratch(True)
-            self.platform.commit_containers(self.images)
+            self.platform.commit_containers(self.images, labels={self.fingerprint_label: fingerprint},
+                                            persist_tmpfs=getattr(self, 'persist_tmpfs', False))
         self.run_containers('rm_container')
         fabric.register_platform(self)
         fabric.set_platform(distrib=self.distri)
@@ -1,11 +1,72 @@
 # encoding: utf-8
 
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import json
+import pipes
+import re
 import time
+import uuid
 
 from . import *
 import utils
 
 
+# opt-in memoization of read-only queries, see enable_query_cache
+query_cache = None
+
+
+def enable_query_cache(ttl=60, maxsize=256):
+    """ Enables memoization of read-only queries (see docker_query), per container.
+        The cached queries of a container are invalidated whenever this library modifies it
+        (non query docker_exec, put_data, start, stop, commit, ...).
+    :return: the utils.QueryCache instance, see its hits, misses and stats()
+    """
+    global query_cache
+    query_cache = utils.QueryCache(ttl, maxsize)
+    return query_cache
+
+
+def disable_query_cache():
+    global query_cache
+    query_cache = None
+
+
+def invalidate_queries(container=None):
+    """ Invalidates the cached queries of a container, or of all containers if container is None
+    """
+    if query_cache is not None:
+        query_cache.invalidate(container)
+
+
+# label of the containers, networks and images created in an isolation namespace
+NAMESPACE_LABEL = 'yadio.namespace'
+
+
+def default_namespace():
+    """ The isolation namespace of the current process: $YADIO_NAMESPACE if set,
+        else the pytest-xdist worker id if any, else no namespace ('').
+    """
+    return os.environ.get('YADIO_NAMESPACE', os.environ.get('PYTEST_XDIST_WORKER', ''))
+
+
+def namespaced(name, namespace=None):
+    """ Appends an isolation namespace to a name
+    :param namespace: defaults to default_namespace()
+    """
+    namespace = default_namespace() if namespace is None else namespace
+    return '-'.join((name, namespace)) if namespace else name
+
+
+def labels_options(labels, option='--label'):
+    return ''.join(" {} '{}={}'".format(option, k, v) for k, v in sorted((labels or {}).items()))
+
+
+# last use time of the images created or used through this library, see image_gc
+images_registry = utils.UsageRegistry(os.path.join(YADIO_HOME, 'images.json'))
+
+
 def get_images(filter=None):
     """ Get images names, with optional filter on name.
     :param filter: if string, get images names containing it, if python container, get images in this set.
@@ -42,7 +103,16 @@ def get_containers(filter=None, image=None, all=True):
 
 
 def get_networks(filter=None, driver=None):
+    """ Get networks names, with optional filter on name.
+    :param filter: if string, get networks names containing it, if python container, get networks in this set.
+           All the networks are queried with a single command, filtered by the docker daemon.
+    :param driver: if string, get only networks using this driver
+    :return: a list of networks names
+    """
     docker_cmd = 'docker network ls'
+    if filter:
+        names = [filter] if isinstance(filter, basestring) else filter
+        docker_cmd += ''.join(' --filter name={}'.format(name) for name in names)
     if driver:
         networks = utils.extract_column(utils.filter_column(utils.Command(docker_cmd).stdout, 2, 1, eq=driver), 1)
     else:
@@ -58,6 +128,7 @@ def get_networks(filter=None, driver=None):
 def container_stop(*container):
     ret = True
     for cont in container:
+        invalidate_queries(cont)
         ret &= not utils.command('docker stop ' + cont)
     return ret
 
@@ -65,6 +136,7 @@ def container_stop(*container):
 def container_delete(*container):
     ret = True
     for cont in container:
+        invalidate_queries(cont)
         ret &= not utils.command('docker rm ' + cont)
     return ret
 
@@ -83,40 +155,213 @@ def image_delete_and_containers(image):
     return image_delete(image)
 
 
-def docker_build(image, tag=None, context=None):
-    cmd = 'docker build -f {}/Dockerfile -t {} .'.format(image, tag or image)
+def docker_build(image, tag=None, context=None, labels=None, build_args=None, network=None):
+    """ Builds an image from <context>/<image>/Dockerfile
+    :param build_args: optional dictionary of build arguments (see package_cache.PackageCache.build_args)
+    :param network: optional network of the build containers
+    """
+    cmd = 'docker build -f {}/Dockerfile -t {}{}{} '.format(image, tag or image, labels_options(labels),
+                                                           labels_options(build_args, '--build-arg'))
+    if network:
+        cmd += '--network {} '.format(network)
+    cmd += '.'
     print(utils.yellow(cmd))
     with utils.cd(context or os.path.join(ROOTDIR, 'images')):
-        return not utils.Command(cmd, show='Build: ').returncode
+        ret = not utils.Command(cmd, show='Build: ').returncode
+    if ret:
+        images_registry.touch(tag or image)
+    return ret
 
 
-def docker_run(image, container, host=None, parameters=None):
-    cmd = 'docker run -d '
+def docker_run(image, container, host=None, parameters=None, network=None, labels=None, tmpfs=None):
+    """ Creates and starts a container
+    :param tmpfs: optional dictionary path: size or mount options (e.g. '512m' or 'size=512m,mode=1777'),
+           of directories mounted as tmpfs. Size None means no limit.
+           Before the container command starts, each tmpfs is filled with its archive made by tmpfs_save
+           if the image has one, or else with the content the image has at its path (see tmpfs_seed).
+           The init script is the container entrypoint: parameters can't set another one, and the image
+           must have a command.
+    """
+    if tmpfs:
+        if re.search(r'(^|\s)--entrypoint[\s=]', parameters or ''):
+            raise ValueError("Container {} has tmpfs directories, its entrypoint can't be set".format(container))
+        entrypoint, command = get_image_command(image)
+        if not entrypoint + command:
+            raise RuntimeError("Image {} has no command to execute after filling the tmpfs".format(image))
+        command = ' '.join(pipes.quote(arg) for arg in entrypoint + command)
+    cmd = 'docker {}{} '.format('create' if tmpfs else 'run -d', labels_options(labels))
     cmd += '--name {} '.format(container)
     cmd += '-h {} '.format(host or container)
+    if network:
+        cmd += '--net {} '.format(network)
+    for path, options in sorted((tmpfs or {}).items()):
+        if options and '=' not in options:
+            options = 'size={}'.format(options)
+        cmd += '--tmpfs {}{} '.format(path, ':rw,' + options if options else '')
+    if tmpfs:
+        cmd += '--entrypoint /bin/sh '
     if parameters:
         cmd += parameters + ' '
     cmd += image
+    if tmpfs:
+        cmd += ' -c {} yadio-tmpfs {}'.format(pipes.quote(tmpfs_init_script(tmpfs)), command)
     print(utils.yellow(cmd))
-    return not utils.command(cmd)
+    invalidate_queries(container)
+    ret = not utils.command(cmd)
+    if ret and tmpfs:
+        ret = tmpfs_seed(image, container, tmpfs)
+        if not ret:
+            container_delete(container)
+        else:
+            ret = not utils.command('docker start {}'.format(container))
+    if ret:
+        # only the images built, committed or loaded here are registered, not the pulled ones
+        images_registry.refresh(image)
+    return ret
+
+
+def get_image_command(image):
+    """ Returns the entrypoint and command of an image, as lists of arguments
+    """
+    output = utils.Command("docker inspect --format '{{json .Config.Entrypoint}}\t{{json .Config.Cmd}}' %s" % image)
+    entrypoint, cmd = output.stdout.strip().split('\t')
+    return json.loads(entrypoint) or [], json.loads(cmd) or []
 
 
 def docker_start(container):
+    invalidate_queries(container)
     return utils.command('docker start {}'.format(container))
 
 
-def docker_commit(container, image):
-    return not utils.command('docker commit {} {}'.format(container, image))
+def docker_commit(container, image, labels=None, command=None):
+    """ Commits a container to an image
+    :param command: optional pair of lists (entrypoint, command) set on the image, e.g. to drop the tmpfs
+           init script of docker_run (see get_image_command)
+    """
+    invalidate_queries(container)
+    changes = ''.join(""" --change 'LABEL {}="{}"'""".format(k, v) for k, v in sorted((labels or {}).items()))
+    if command:
+        changes += """ --change 'ENTRYPOINT {}' --change 'CMD {}'""".format(json.dumps(command[0]),
+                                                                           json.dumps(command[1]))
+    ret = not utils.command('docker commit{} {} {}'.format(changes, container, image))
+    if ret:
+        images_registry.touch(image)
+    return ret
+
+
+def docker_save(image, path):
+    """ Saves an image to a tar archive
+    """
+    return not utils.command('docker save -o {} {}'.format(path, image))
+
+
+def docker_load(path, image=None):
+    """ Loads images from a tar archive
+    :param image: if not None, the name of the image in the archive, marked as used (see image_gc)
+    """
+    ret = not utils.command('docker load -i {} >/dev/null'.format(path))
+    if ret and image:
+        images_registry.touch(image)
+    return ret
+
+
+def inspect_images(images, template):
+    """ Inspects images with a single command.
+    :param images: an iterable of images names
+    :param template: a 'docker inspect' go template, rendered on a single line
+    :return: a dict image: rendered template, for existing images only
+    """
+    images = list(images)
+    if not images:
+        return {}
+    docker_cmd = "docker image inspect --format '{}\t{{{{range .RepoTags}}}}{{{{.}}}} {{{{end}}}}' {}".\
+        format(template, ' '.join(images))
+    values = {}
+    for line in utils.Command(docker_cmd).stdout.splitlines():
+        value, _, tags = line.rpartition('\t')
+        value = '' if value == '<no value>' else value
+        for tag in tags.split():
+            values[tag] = value
+            if tag.endswith(':latest'):
+                values[tag[:-len(':latest')]] = value
+    return {image: values[image] for image in images if image in values}
+
+
+def get_images_sizes(images):
+    """ Get the sizes of images, with a single command.
+    :param images: an iterable of images names
+    :return: a dict image: size in bytes, for existing images only
+    """
+    return {k: int(v) for k, v in inspect_images(images, '{{.Size}}').iteritems()}
+
 
+def get_images_ids(images):
+    return inspect_images(images, '{{.Id}}')
 
-def get_container_ip(container, raises=False):
-    docker_cmd = utils.Command("docker inspect --format '{{ .NetworkSettings.IPAddress }}' %s" % container)
+
+def get_images_label(images, label):
+    """ Get the value of a label of images, with a single command.
+    :return: a dict image: label value ('' if not set), for existing images only
+    """
+    return inspect_images(images, '{{index .Config.Labels "%s"}}' % label)
+
+
+def image_gc(budget, dry_run=False, registry=None):
+    """ Deletes the least recently used images created or used through this library,
+        until their total size fits in budget. Images used by a container (even stopped) are kept.
+        Sizes are the images virtual sizes, layers shared by images are counted several times.
+    :param budget: maximum total size, in bytes
+    :param dry_run: if True, nothing is deleted
+    :param registry: the utils.UsageRegistry of the images, defaults to images_registry
+    :return: a report dict with keys 'total' (size before eviction), 'reclaimable' (size of the
+             evicted images), 'evicted' (list of evicted (image, size, last use time)), 'in_use'
+             (list of images kept because of a container)
+    """
+    registry = registry or images_registry
+    usage = registry.usage()
+    sizes = get_images_sizes(usage)
+    if not dry_run:
+        registry.forget(*set(usage).difference(sizes))
+    in_use = set(utils.Command("docker ps -a --format '{{.Image}}'").stdout.split())
+    in_use = set(image for image in sizes if image in in_use or image + ':latest' in in_use)
+    total = sum(sizes.itervalues())
+    report = {'total': total, 'reclaimable': 0, 'evicted': [], 'in_use': sorted(in_use)}
+    for image in sorted(sizes, key=usage.get):
+        if total - report['reclaimable'] <= budget:
+            break
+        if image in in_use:
+            continue
+        if not dry_run:
+            print(utils.red("Delete image {}".format(image)))
+            if not image_delete(image):
+                continue
+            registry.forget(image)
+        report['evicted'].append((image, sizes[image], usage[image]))
+        report['reclaimable'] += sizes[image]
+    return report
+
+
+def get_container_ip(container, raises=False, network=None):
+    """ Get the ip of a container on a network, or by default on the bridge network,
+        or else on the first network it is connected to.
+    """
+    if network:
+        docker_format = '{{with index .NetworkSettings.Networks "%s"}}{{ .IPAddress }}{{end}}' % network
+    else:
+        docker_format = '{{ .NetworkSettings.IPAddress }} {{range .NetworkSettings.Networks}}{{ .IPAddress }} {{end}}'
+    docker_cmd = utils.Command("docker inspect --format '%s' %s" % (docker_format, container))
     if raises and docker_cmd.stderr:
         raise RuntimeError("Container {} is not running".format(container))
-    return docker_cmd.stdout.strip()
+    ips = docker_cmd.stdout.split()
+    return ips[0] if ips else ''
+
+
+def get_container_networks(container):
+    docker_cmd = "docker inspect --format '{{range $k, $v := .NetworkSettings.Networks}}{{$k}} {{end}}' %s"
+    return utils.Command(docker_cmd % container).stdout.split()
 
 
-def docker_exec(cmd, container, user=None, raises=False, status_only=False, stdout_only=True):
+def docker_exec(cmd, container, user=None, raises=False, status_only=False, stdout_only=True, query=False):
     """ Executes a command on a running container via 'docker exec'
     :param cmd: the command to execute
     :param container: the target container
@@ -124,8 +369,11 @@ def docker_exec(cmd, container, user=None, raises=False, status_only=False, stdo
     :param raises: if True, will raise a RuntimeError exception if command fails (return code != 0)
     :param status_only: If True, will return True if command succeeds, False if it fails
     :param stdout_only: If True, will return stdout as a string (default=True)
+    :param query: If True, the command does not modify the container, so the cached queries are kept
     :return: a subprocess.Popen object, or a string if stdout_only=True, or a boolean if status_only=True
     """
+    if not query:
+        invalidate_queries(container)
     docker_cmd = 'docker exec -i {} {} {}'.format('-u {}'.format(user) if user else '', container, cmd)
     dock = utils.Command(docker_cmd)
     if raises and dock.returncode:
@@ -139,15 +387,214 @@ def docker_exec(cmd, container, user=None, raises=False, status_only=False, stdo
     return dock
 
 
-def docker_network(name, cmd='create', raises=True):
+def docker_query(cmd, container, user=None, status_only=False):
+    """ Executes a read-only command via 'docker exec', memoized if the query cache is enabled.
+    :return: stdout as a string, or a boolean if status_only=True
+    """
+    if query_cache is None:
+        return docker_exec(cmd, container, user=user, status_only=status_only, query=True)
+    return query_cache.get(container, (cmd, user, status_only),
+                           lambda: docker_exec(cmd, container, user=user, status_only=status_only, query=True))
+
+
+BatchResult = namedtuple('BatchResult', 'cmd returncode stdout stderr')
+
+
+class Batch(object):
+    """ Queues commands, then runs them as a single shell script in a single 'docker exec'.
+        Each command runs in its own subshell, with stdin redirected from /dev/null, and its
+        outputs are framed by delimiters so that per-command results can be retrieved.
+    """
+
+    def __init__(self, user=None, stop_on_error=False):
+        """
+        :param user: an optional user (defaults to root)
+        :param stop_on_error: if True, the commands following a failed command are not executed
+        """
+        self.user = user
+        self.stop_on_error = stop_on_error
+        self.commands = []
+        self.results = None
+
+    def run(self, cmd):
+        self.commands.append(cmd)
+        return self
+
+    def marker(self):
+        """ A unique frame delimiter, derived from the commands when recording or replaying
+            so that the recorded script and output match the replayed ones (see utils.recording)
+        """
+        if utils.recorder is None and utils.replayer is None:
+            return 'YADIO-' + uuid.uuid4().hex
+        digest = hashlib.sha1(repr((self.user, self.stop_on_error, self.commands))).hexdigest()
+        return 'YADIO-' + digest
+
+    def script(self, marker):
+        lines = []
+        for i, cmd in enumerate(self.commands):
+            lines.append("echo '{0}:{1}'; echo '{0}:{1}' >&2".format(marker, i))
+            lines.append('(\n{}\n) </dev/null'.format(cmd))
+            lines.append('ret=$?; echo; echo "{0}:{1}:$ret"; echo >&2; echo "{0}:{1}:$ret" >&2'.format(marker, i))
+            if self.stop_on_error:
+                lines.append('[ $ret -eq 0 ] || exit $ret')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def parse(output, marker, count):
+        """ Extracts the framed outputs of the commands
+        :return: a list of pairs (output, return code), one per executed command
+        """
+        frames, pos = [], 0
+        for i in xrange(count):
+            begin = '{}:{}\n'.format(marker, i)
+            end = '\n{}:{}:'.format(marker, i)
+            start = output.find(begin, pos)
+            if start < 0:
+                break
+            start += len(begin)
+            stop = output.find(end, start)
+            if stop < 0:
+                break
+            pos = output.index('\n', stop + len(end))
+            frames.append((output[start:stop], int(output[stop + len(end):pos])))
+        return frames
+
+    def execute(self, container, raises=False):
+        """ Runs the queued commands on a container.
+        :param raises: if True, will raise a RuntimeError if a command fails
+        :return: a list of BatchResult, one per executed command
+        """
+        invalidate_queries(container)
+        marker = self.marker()
+        docker_cmd = 'docker exec -i {} {} /bin/bash -s'.format('-u {}'.format(self.user) if self.user else '',
+                                                              container)
+        dock = utils.Command(docker_cmd, datain=self.script(marker))
+        outs = self.parse(dock.stdout, marker, len(self.commands))
+        errs = self.parse(dock.stderr, marker, len(self.commands))
+        if dock.returncode and not outs:
+            raise RuntimeError("Error while executing batch on {}: [{}]".
+                               format(container, dock.stderr.strip() or dock.returncode))
+        results = [BatchResult(cmd, ret, out, err) for cmd, (out, ret), (err, _) in zip(self.commands, outs, errs)]
+        if raises:
+            for result in results:
+                if result.returncode:
+                    raise RuntimeError("Error while executing <{}> on {}: [{}]".
+                                       format(result.cmd, container, result.stderr.strip() or result.returncode))
+        return results
+
+
+@contextmanager
+def batch(container, user=None, raises=False, stop_on_error=False):
+    """ Context manager yielding a Batch, executed on container at exit (unless an exception occurs).
+        Results are available afterwards in the Batch 'results' attribute.
+    """
+    b = Batch(user, stop_on_error)
+    yield b
+    b.results = b.execute(container, raises)
+
+
+# directory of the containers where the content of tmpfs directories is archived, see tmpfs_save
+TMPFS_ARCHIVES = '/var/lib/yadio/tmpfs'
+
+
+def _tmpfs_archive(path):
+    return '{}/{}.tar'.format(TMPFS_ARCHIVES, path.strip('/').replace('/', '_'))
+
+
+# directory of the containers where the image content of tmpfs directories is copied, see tmpfs_seed
+TMPFS_SEEDS = '/var/lib/yadio/seed'
+# processes suspended by tmpfs_save
+_FROZEN = '/var/lib/yadio/frozen'
+
+
+def tmpfs_save(container, paths, services=()):
+    """ Archives the content of tmpfs directories in the container filesystem, so that it is kept
+        by 'docker commit' (which ignores tmpfs mounts). See docker_run for their restoration.
+        The services are stopped first, and the other processes of the container are suspended while
+        archiving, so that the archives are consistent snapshots. The services are started again afterwards.
+    :param services: names of services stopped with 'service <name> stop'
+    """
+    with batch(container, raises=True) as b:
+        for service in services:
+            b.run('service {} stop'.format(service))
+        b.run('mkdir -p {}'.format(TMPFS_ARCHIVES))
+        b.run('for pid in $(ls /proc | grep -E "^[0-9]+$"); do '
+              '[ $pid -eq 1 -o $pid -eq $$ -o $pid -eq $BASHPID ] || { kill -STOP $pid 2>/dev/null && echo $pid; }; '
+              'done > {}; true'.format(_FROZEN))
+        for path in paths:
+            b.run('tar cf {} -C {} .'.format(_tmpfs_archive(path), path))
+        b.run('kill -CONT $(cat {0}) 2>/dev/null; rm -f {0}; true'.format(_FROZEN))
+        for service in services:
+            b.run('service {} start'.format(service))
+
+
+def tmpfs_seed(image, container, paths):
+    """ Copies the content of directories of an image into a created container, under TMPFS_SEEDS,
+        from where the init script of its tmpfs copies it (see tmpfs_init_script).
+        Fails if the image has no GNU tar.
+    """
+    seeds = TMPFS_SEEDS.strip('/') + '/'
+    # the status of the tar side of the pipe matters too
+    return not utils.command("bash -o pipefail -c {}".format(pipes.quote(
+        "docker run --rm -u root --net none --entrypoint tar {} --ignore-failed-read "
+        "--transform 's,^,{},' -C / -cf - {} | docker cp -a - {}:/".
+        format(image, seeds, ' '.join(path.strip('/') for path in sorted(paths)), container))))
+
+
+def tmpfs_init_script(paths):
+    """ The shell script filling the tmpfs directories of a container before executing its command:
+        with their archive made by tmpfs_save if any, or else with the image content (see tmpfs_seed).
+        The image content is then removed, so that it is not kept by 'docker commit'.
+    """
+    lines = []
+    for path in sorted(paths):
+        archive, seed = _tmpfs_archive(path), TMPFS_SEEDS + path
+        lines.append('if [ -f {0} ]; then tar xpf {0} -C {1}; '
+                     'elif [ -d {2} ]; then cp -a {2}/. {1}/ && chown --reference={2} {1} '
+                     '&& chmod --reference={2} {1}; fi'.format(archive, path, seed))
+    lines.append('rm -rf {}'.format(TMPFS_SEEDS))
+    lines.append('exec "$@"')
+    return '\n'.join(lines)
+
+
+def exec_session(container, user=None):
+    """ Opens a persistent shell session on a running container, see utils.ShellSession.
+        Unlike docker_exec, commands executed in a session don't invalidate the cached queries.
+    """
+    return utils.ShellSession('docker exec -i {} {} /bin/bash'.format('-u {}'.format(user) if user else '',
+                                                                       container))
+
+
+def docker_network(name, cmd='create', raises=True, labels=None):
     allowed = ('create', 'remove')
     if cmd not in allowed:
         raise RuntimeError("Network command must be in {}, found {}".format(allowed, cmd))
-    ret = utils.command('docker network {} {}'.format(cmd, name))
+    options = labels_options(labels) if cmd == 'create' else ''
+    ret = utils.command('docker network {}{} {}'.format(cmd, options, name))
     if ret and raises:
         raise RuntimeError("Could not {} network {}".format(cmd, name))
 
 
+def namespace_cleanup(namespace):
+    """ Removes all the containers (even running), networks and images labelled with an isolation namespace.
+        Images still used by containers of other namespaces are kept.
+    :return: a dict with the number of removed 'containers', 'networks' and 'images'
+    """
+    if not namespace:
+        raise ValueError("namespace_cleanup requires a non empty namespace")
+    label = "--filter 'label={}={}'".format(NAMESPACE_LABEL, namespace)
+    removed = {}
+    for kind, list_cmd, rm_cmd in (('containers', 'docker ps -aq', 'docker rm -f'),
+                                   ('networks', 'docker network ls -q', 'docker network rm'),
+                                   ('images', 'docker images -q', 'docker rmi')):
+        ids = set(utils.Command('{} {}'.format(list_cmd, label)).stdout.split())
+        if ids:
+            utils.command('{} {} >/dev/null 2>&1'.format(rm_cmd, ' '.join(ids)))
+        removed[kind] = len(ids) - len(set(utils.Command('{} {}'.format(list_cmd, label)).stdout.split()))
+    invalidate_queries()
+    return removed
+
+
 def network_connect(network, container):
     if utils.command('docker network connect {} {}'.format(network, container)):
         raise RuntimeError("Could not connect {} to network {}".format(container, network))
@@ -155,7 +602,8 @@ def network_connect(network, container):
 
 def put_data(data, dest, container, append=False, user=None, perms=None):
     """ Copy data to a file with optional append and user/perms settings.
-    :param data: byte string of data
+    :param data: byte string of data, or file-like object (file, mmap, ...), or iterable of byte strings.
+           Data is streamed to the container in constant memory.
     :param dest: file path on target container. The directory must exist
     :param container: container name
     :param append: if True, the data is appended to the file, otherwise, the file is created or overwritten
@@ -164,6 +612,7 @@ def put_data(data, dest, container, append=False, user=None, perms=None):
     """
     if append and not path_exists(dest, container):
         docker_exec('touch {}'.format(dest), container)
+    invalidate_queries(container)
     docker_cmd = 'docker exec -i {} /bin/bash -c "cat {} {}"'.format(container, '>>' if append else '>', dest)
     utils.command_input(docker_cmd, data, raises=True)
     if user:
@@ -174,6 +623,7 @@ def put_data(data, dest, container, append=False, user=None, perms=None):
 
 def put_file(source, dest, container, user=None, perms=None):
     docker_cmd = 'docker cp {} {}:{}'.format(source, container, dest)
+    invalidate_queries(container)
     utils.command(docker_cmd, raises=True)
     if user:
         path_set_user(dest, user, container)
@@ -185,16 +635,61 @@ def put_directory(source, dest, container):
     docker_exec('mkdir -p {}'.format(dest), container, raises=True)
     with utils.cd(source):
         ret = utils.command('tar zc * | docker exec -i {} tar zx -C {}'.format(container, dest))
+        invalidate_queries(container)
         if ret:
             raise RuntimeError("Error while copying {} to {}:{}".format(source, container, dest))
 
 
-def get_data(source, container):
-    return docker_exec('cat {}'.format(source), container, raises=True)
+def _read_command(source, offset=0, length=None, tail=None):
+    if tail is not None:
+        return 'tail -c {} {}'.format(tail, source)
+    cmd = 'tail -c +{} {}'.format(offset + 1, source) if offset else 'cat {}'.format(source)
+    if length is not None:
+        cmd += ' | head -c {}'.format(length)
+    return cmd
+
+
+def iter_data(source, container, offset=0, length=None, tail=None, chunk_size=utils.CHUNK_SIZE):
+    """ Reads a file chunk by chunk, without loading it in memory.
+    :param source: file path on container
+    :param container: container name
+    :param offset: number of bytes to skip at the start of the file
+    :param length: if not None, maximum number of bytes to read
+    :param tail: if not None, read only the last 'tail' bytes of the file (offset and length are ignored)
+    :param chunk_size: size of the yielded chunks (the last one may be shorter)
+    :return: a generator of byte strings. Raises a RuntimeError if the file can't be read
+    """
+    docker_cmd = 'docker exec {} /bin/bash -c "{}"'.format(container, _read_command(source, offset, length, tail))
+    return utils.command_stream(docker_cmd, chunk_size, raises=True)
+
+
+def get_data(source, container, dest=None, offset=0, length=None, tail=None):
+    """ Reads a file, or a byte range of a file, see iter_data.
+    :param dest: if not None, the data is streamed to this local file path instead of being returned.
+           The data is written to a temporary file renamed to dest once complete, so that a failed read
+           leaves no truncated dest.
+    :return: the data as a byte string, or the number of bytes written if dest is not None
+    """
+    chunks = iter_data(source, container, offset, length, tail)
+    if dest is None:
+        return ''.join(chunks)
+    size = 0
+    tmp = '{}.{}.part'.format(dest, uuid.uuid4().hex)
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.rename(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return size
 
 
 def path_exists(path, container):
-    return docker_exec('test -e {}'.format(path), container, status_only=True)
+    return docker_exec('test -e {}'.format(path), container, status_only=True, query=True)
 
 
 def create_user(user, container, groups=(), home=None, shell=None):
@@ -204,12 +699,11 @@ def create_user(user, container, groups=(), home=None, shell=None):
         format(user,
                ' -d {}'.format(home) if home else '',
                ' -s {}'.format(shell) if shell else '')
-    docker_exec(cmd, container)
-    existing_groups = utils.extract_column(docker_exec('cat /etc/group', container), 0, sep=':')
-    for group in groups:
-        if group not in existing_groups:
-            docker_exec('addgroup {}'.format(group), container)
-        docker_exec('usermod -a -G {} {}'.format(group, user), container)
+    with batch(container) as b:
+        b.run(cmd)
+        for group in groups:
+            b.run('getent group {0} >/dev/null || addgroup {0}'.format(group))
+            b.run('usermod -a -G {} {}'.format(group, user))
 
 
 def path_set_user(path, user, container, group=None, recursive=False):
@@ -223,7 +717,7 @@ def set_permissions(path, perms, container, recursive=False):
 
 
 def get_version(app, container):
-    output = docker_exec('apt-cache policy {}'.format(app), container, user='root')
+    output = docker_query('apt-cache policy {}'.format(app), container, user='root')
     try:
         return utils.extract_column(utils.filter_column(output, 0, startswith='Install'), 1, sep=':')[0]
     except IndexError:
@@ -233,14 +727,85 @@ def get_version(app, container):
 def wait_running_process(cmd, container, timeout=1):
     count, step = timeout, 0.2
     while count > 0:
-        if cmd in utils.extract_column(docker_exec('ps -A', container, user='root'), -1, 1):
+        if cmd in utils.extract_column(docker_exec('ps -A', container, user='root', query=True), -1, 1):
             return True
         time.sleep(step)
         count -= step
 
 
 def get_processes(container, filter=None):
-    processes = utils.extract_column(docker_exec('ps -A', container, user='root'), -1, 1)
+    processes = utils.extract_column(docker_query('ps -A', container, user='root'), -1, 1)
     if filter is None:
         return processes
     return [proc for proc in processes if filter in proc]
+
+
+Process = namedtuple('Process', 'pid ppid user cmdline cpu_time rss')
+
+# prints clock ticks, page size, own pids, then a line uid<TAB>stat<TAB>cmdline per process, then /etc/passwd
+PROCESS_TABLE_SCRIPT = r"""getconf CLK_TCK
+getconf PAGESIZE
+echo $$ $BASHPID
+for d in /proc/[0-9]*; do
+    stat=$(cat $d/stat 2>/dev/null) || continue
+    uid=$(awk '/^Uid:/ {print $2}' $d/status 2>/dev/null)
+    cmdline=$(tr '\0\n\t' '   ' < $d/cmdline 2>/dev/null)
+    printf '%s\t%s\t%s\n' "$uid" "$stat" "$cmdline"
+done
+echo
+cat /etc/passwd
+"""
+
+
+def parse_process_table(output):
+    """ Parses the output of PROCESS_TABLE_SCRIPT
+    :return: a list of Process, sorted by pid, excluding the processes of the script itself.
+             cpu_time is in seconds, rss in bytes, cmdline is '[name]' for kernel threads
+    """
+    table, _, passwd = output.partition('\n\n')
+    lines = table.splitlines()
+    clk_tck, page_size = int(lines[0]), int(lines[1])
+    own = set(int(pid) for pid in lines[2].split())
+    users = {}
+    for line in passwd.splitlines():
+        elts = line.split(':')
+        if len(elts) > 2:
+            users[elts[2]] = elts[0]
+    processes = []
+    for line in lines[3:]:
+        uid, stat, cmdline = line.split('\t', 2)
+        head, _, tail = stat.rpartition(')')
+        pid, _, name = head.partition(' (')
+        fields = tail.split()
+        pid, ppid = int(pid), int(fields[1])
+        if pid in own or ppid in own:
+            continue
+        processes.append(Process(pid, ppid, users.get(uid, uid), cmdline.strip() or '[{}]'.format(name),
+                                 float(int(fields[11]) + int(fields[12])) / clk_tck, int(fields[21]) * page_size))
+    return sorted(processes)
+
+
+def get_process_table(container, filter=None):
+    """ Takes a snapshot of the processes of a container, reading /proc with a single exec.
+    :param filter: an optional predicate on Process
+    :return: a list of Process
+    """
+    with batch(container, user='root', raises=True) as b:
+        b.run(PROCESS_TABLE_SCRIPT)
+    processes = parse_process_table(b.results[0].stdout)
+    if filter is None:
+        return processes
+    return [proc for proc in processes if filter(proc)]
+
+
+def diff_processes(before, after):
+    """ Compares two process snapshots, processes being identified by pid and command line.
+    :param before, after: lists of Process, or dicts host: list of Process
+    :return: a pair of lists (started, ended) of Process, or a dict host: pair
+    """
+    if isinstance(before, dict):
+        return {k: diff_processes(before.get(k, []), after.get(k, [])) for k in set(before).union(after)}
+    before_keys = set((p.pid, p.cmdline) for p in before)
+    after_keys = set((p.pid, p.cmdline) for p in after)
+    return ([p for p in after if (p.pid, p.cmdline) not in before_keys],
+            [p for p in before if (p.pid, p.cmdline) not in after_keys])
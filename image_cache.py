@@ -0,0 +1,174 @@
+# encoding: utf-8
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+from . import *
+from docker_basics import docker_build, docker_load, docker_save, get_images_ids
+import utils
+
+
+def dockerfile_instructions(path):
+    """ Parses a Dockerfile, lines continued with a backslash are joined
+    :return: a list of (upper case instruction, arguments string)
+    """
+    instructions, line = [], ''
+    with open(path) as f:
+        for part in f:
+            part = part.strip()
+            if not part or part.startswith('#'):
+                continue
+            if part.endswith('\\'):
+                line += part[:-1] + ' '
+                continue
+            elts = (line + part).split(None, 1)
+            line = ''
+            if elts:
+                instructions.append((elts[0].upper(), elts[1].strip() if len(elts) > 1 else ''))
+    return instructions
+
+
+def base_images(image, context=None):
+    """ Lists the images a Dockerfile is built from (its FROM instructions, except the build stages and scratch)
+    """
+    context = context or os.path.join(ROOTDIR, 'images')
+    bases, stages = [], set()
+    for instruction, args in dockerfile_instructions(os.path.join(context, image, 'Dockerfile')):
+        if instruction != 'FROM':
+            continue
+        args = [arg for arg in args.split() if not arg.startswith('--')]
+        if args[0] not in stages and args[0] != 'scratch' and args[0] not in bases:
+            bases.append(args[0])
+        if len(args) == 3 and args[1].upper() == 'AS':
+            stages.add(args[2])
+    return bases
+
+
+def build_inputs(image, context=None):
+    """ Lists the files a build depends on: the Dockerfile and the sources of its COPY and ADD instructions.
+    :param image: the image name, its Dockerfile is <context>/<image>/Dockerfile (see docker_basics.docker_build)
+    :param context: the build context, defaults to the images directory of this project
+    :return: a sorted list of files paths, relative to context
+    """
+    context = context or os.path.join(ROOTDIR, 'images')
+    dockerfile = os.path.join(image, 'Dockerfile')
+    inputs = {dockerfile}
+    for instruction, args in dockerfile_instructions(os.path.join(context, dockerfile)):
+        if instruction not in ('COPY', 'ADD') or not args:
+            continue
+        args = json.loads(args) if args.startswith('[') else args.split()
+        sources = [arg for arg in args if not arg.startswith('--')][:-1]
+        for source in sources:
+            if '://' in source:
+                continue
+            for path in glob.glob(os.path.join(context, source)):
+                if os.path.isdir(path):
+                    for root, _, files in os.walk(path):
+                        inputs.update(os.path.relpath(os.path.join(root, name), context) for name in files)
+                else:
+                    inputs.add(os.path.relpath(path, context))
+    return sorted(inputs)
+
+
+def build_key(image, tag=None, context=None, labels=None):
+    """ Content address of a build: a hash of the image tag, of the labels set by the build,
+        of the ids of the base images (empty if not pulled yet) and of the build inputs names and contents
+    """
+    context = context or os.path.join(ROOTDIR, 'images')
+    sha = hashlib.sha256(tag or image)
+    sha.update(json.dumps(labels or {}, sort_keys=True))
+    bases = base_images(image, context)
+    ids = get_images_ids(bases)
+    for base in bases:
+        sha.update('\0{}\0{}'.format(base, ids.get(base, '')))
+    for path in build_inputs(image, context):
+        sha.update('\0' + path + '\0')
+        with open(os.path.join(context, path), 'rb') as f:
+            for chunk in utils.iter_chunks(f):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ImageArchive(object):
+    """ Local content addressed store of images archives ('docker save'), keyed by build inputs.
+        Building an image through the archive loads it instead if its inputs are unchanged.
+        Archives are evicted, least recently used first, when their total size exceeds max_size.
+    """
+
+    def __init__(self, root=os.path.join(YADIO_HOME, 'archives'), max_size=10 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.tar')
+
+    def load(self, image, tag=None, context=None, labels=None):
+        """ Loads the archive of an image, if any
+        :return: True if the image was loaded
+        """
+        path = self.path(build_key(image, tag, context, labels))
+        if not os.path.exists(path):
+            return False
+        print(utils.yellow("Load image {} from {}".format(tag or image, path)))
+        if not docker_load(path, tag or image):
+            return False
+        os.utime(path, None)
+        return True
+
+    def save(self, image, tag=None, context=None, labels=None):
+        """ Saves an image to the archive, then evicts archives if needed
+        :param labels: the labels the image was built with, part of the archive key
+        """
+        path = self.path(build_key(image, tag, context, labels))
+        tmp = '{}.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+        if not docker_save(tag or image, tmp):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        os.rename(tmp, path)
+        self.evict()
+        return True
+
+    def build(self, image, tag=None, context=None, labels=None, **options):
+        """ Loads an image from the archive, or else builds and archives it (see docker_basics.docker_build)
+        :param labels: labels set on the image, part of the archive key, so that an image labelled
+               for a namespace is never loaded in another one
+        :param options: build_args and network, passed to docker_build, they are not part of the archive key
+        """
+        if self.load(image, tag, context, labels):
+            return True
+        if not docker_build(image, tag, context, labels, **options):
+            return False
+        self.save(image, tag, context, labels)
+        return True
+
+    def archives(self):
+        """ Returns the list of (path, size, last use time) of the archives, least recently used first
+        """
+        archives = []
+        for path in glob.glob(os.path.join(self.root, '*.tar')):
+            stat = os.stat(path)
+            archives.append((path, stat.st_size, stat.st_mtime))
+        return sorted(archives, key=lambda x: x[2])
+
+    def evict(self):
+        """ Removes the least recently used archives until their total size fits in max_size
+        :return: the list of removed archives paths
+        """
+        with self.lock:
+            archives = self.archives()
+            total = sum(size for _, size, _ in archives)
+            removed = []
+            for path, size, _ in archives:
+                if total <= self.max_size:
+                    break
+                os.remove(path)
+                removed.append(path)
+                total -= size
+            return removed
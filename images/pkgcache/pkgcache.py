@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+""" A caching proxy for apt and pip, used as a build sidecar.
+    - apt: set http_proxy=http://<host>:<port>, packages (.deb) are cached, indexes are not.
+    - pip: set PIP_INDEX_URL=http://<host>:<port>/pypi/simple/, distributions are cached, indexes are not.
+    - GET /_stats returns the cache statistics as json, also written to <cache-dir>/stats.json
+    Statistics are cumulated across restarts, as long as the cache directory is kept.
+"""
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import SocketServer
+import sys
+import threading
+import urllib2
+import urlparse
+
+CACHED_EXTENSIONS = ('.deb', '.udeb', '.whl', '.tar.gz', '.tgz', '.zip', '.tar.bz2', '.egg')
+
+
+class Cache(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'passthrough': 0, 'bytes_served_from_cache': 0}
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        try:
+            with open(os.path.join(folder, 'stats.json')) as f:
+                self.stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        self.save()
+
+    def save(self):
+        tmp = os.path.join(self.folder, 'stats.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.stats, f)
+        os.rename(tmp, os.path.join(self.folder, 'stats.json'))
+
+    def path(self, url):
+        return os.path.join(self.folder, hashlib.sha256(url).hexdigest())
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+            self.save()
+
+    def fetch(self, url):
+        """ Returns the path of the cached content of url, downloading it if needed
+        """
+        path = self.path(url)
+        if os.path.exists(path):
+            self.count('hits')
+            self.count('bytes_served_from_cache', os.path.getsize(path))
+            return path
+        self.count('misses')
+        tmp = '{}.{}'.format(path, threading.current_thread().ident)
+        response = urllib2.urlopen(url)
+        with open(tmp, 'wb') as f:
+            shutil.copyfileobj(response, f)
+        os.rename(tmp, path)
+        return path
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        try:
+            url = urlparse.urlsplit(self.path)
+            path = url.path
+            if url.scheme and not path.startswith(('/pypi/', '/_stats')):
+                # proxy request, as sent by apt
+                self.serve(self.path)
+            elif path == '/_stats':
+                self.send_data(json.dumps(self.server.cache.stats), 'application/json')
+            elif path.startswith('/pypi/simple/'):
+                self.serve_index(self.server.pypi_upstream + path[len('/pypi'):])
+            elif path.startswith('/pypi/files/'):
+                self.serve(self.server.files_upstream + path[len('/pypi/files'):])
+            else:
+                self.send_error(404)
+        except urllib2.HTTPError as e:
+            self.send_error(e.code)
+        except (urllib2.URLError, IOError) as e:
+            self.send_error(502, str(e))
+
+    def serve(self, url):
+        if not urlparse.urlsplit(url).path.endswith(CACHED_EXTENSIONS):
+            self.server.cache.count('passthrough')
+            response = urllib2.urlopen(url)
+            self.send_data(response.read(), response.info().gettype())
+            return
+        path = self.server.cache.fetch(url)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def serve_index(self, url):
+        """ Serves a pip simple index page, with distribution links rewritten to this proxy
+        """
+        self.server.cache.count('passthrough')
+        response = urllib2.urlopen(url)
+        page = response.read()
+        page = page.replace(self.server.files_upstream, 'http://{}/pypi/files'.format(self.headers.get('Host')))
+        self.send_data(page, response.info().gettype())
+
+    def send_data(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache_dir, pypi_upstream='https://pypi.org',
+                 files_upstream='https://files.pythonhosted.org', verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.cache = Cache(cache_dir)
+        self.pypi_upstream = pypi_upstream.rstrip('/')
+        self.files_upstream = files_upstream.rstrip('/')
+        self.verbose = verbose
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PKGCACHE_PORT', 3142)))
+    parser.add_argument('--cache-dir', default='/var/cache/pkgcache')
+    parser.add_argument('--pypi-upstream', default=os.environ.get('PKGCACHE_PYPI_UPSTREAM', 'https://pypi.org'))
+    parser.add_argument('--files-upstream',
+                        default=os.environ.get('PKGCACHE_FILES_UPSTREAM', 'https://files.pythonhosted.org'))
+    parser.add_argument('--ping', action='store_true', help="exits with 0 if the proxy is serving, else 1")
+    args = parser.parse_args()
+    if args.ping:
+        try:
+            urllib2.urlopen('http://localhost:{}/_stats'.format(args.port), timeout=1).read()
+        except (urllib2.URLError, IOError):
+            sys.exit(1)
+        return
+    Server(('', args.port), args.cache_dir, args.pypi_upstream, args.files_upstream, verbose=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
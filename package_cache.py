@@ -0,0 +1,94 @@
+# encoding: utf-8
+
+import json
+import time
+
+from docker_basics import (docker_build, docker_exec, docker_run, docker_start, get_container_ip, get_containers,
+                           get_images)
+import utils
+
+CACHE_DIR = '/var/cache/pkgcache'
+
+
+class PackageCache(object):
+    """ A caching proxy container for apt and pip (see images/pkgcache), used as a sidecar of image builds.
+        It is shared by all builds and platforms, its cache is kept in a docker volume across restarts.
+    """
+
+    def __init__(self, container='yadio-pkgcache', image='pkgcache', volume='yadio-pkgcache', network=None,
+                 port=3142, upstreams=None, timeout=10):
+        """
+        :param network: the network of the proxy and of the builds using it (defaults to the bridge network)
+        :param upstreams: optional dictionary of the proxy environment, e.g. {'PKGCACHE_PYPI_UPSTREAM': url}
+        :param timeout: time to wait for the proxy to serve, in seconds
+        """
+        self.container = container
+        self.image = image
+        self.volume = volume
+        self.network = network
+        self.port = port
+        self.upstreams = upstreams or {}
+        self.timeout = timeout
+
+    def running(self):
+        return self.container in get_containers([self.container], all=False)
+
+    def start(self):
+        """ Starts the proxy container if it is not running, building its image if needed
+        :return: the proxy ip
+        """
+        if not self.running():
+            if self.container in get_containers([self.container]):
+                docker_start(self.container)
+            else:
+                if self.image not in get_images([self.image]):
+                    docker_build(self.image)
+                parameters = '-v {}:{} '.format(self.volume, CACHE_DIR)
+                parameters += ''.join('-e {}={} '.format(k, v) for k, v in sorted(self.upstreams.items()))
+                parameters += '-e PKGCACHE_PORT={}'.format(self.port)
+                docker_run(self.image, self.container, parameters=parameters, network=self.network)
+            self.wait()
+        return self.ip()
+
+    def wait(self):
+        count, step = self.timeout, 0.2
+        while count > 0:
+            if docker_exec('python /pkgcache.py --ping', self.container, status_only=True, query=True):
+                return True
+            time.sleep(step)
+            count -= step
+        raise RuntimeError("Package cache {} is not serving".format(self.container))
+
+    def stop(self):
+        return not utils.command('docker rm -f {}'.format(self.container))
+
+    def ip(self):
+        return get_container_ip(self.container, raises=True, network=self.network)
+
+    def build_args(self):
+        """ The build arguments routing apt and pip through the proxy.
+            Pip only uses them if the Dockerfile declares ARG PIP_INDEX_URL and ARG PIP_TRUSTED_HOST,
+            preferably just before the pip instructions, as declared arguments are part of the build cache key
+            of the following instructions (see images/debian8). The proxy arguments are predefined by docker.
+        """
+        ip = self.ip()
+        return {'http_proxy': 'http://{}:{}'.format(ip, self.port),
+                'no_proxy': ip,
+                'PIP_INDEX_URL': 'http://{}:{}/pypi/simple/'.format(ip, self.port),
+                'PIP_TRUSTED_HOST': ip}
+
+    def build_options(self):
+        """ Starts the proxy and returns the build_args and network options of docker_basics.docker_build
+        """
+        self.start()
+        return {'build_args': self.build_args(), 'network': self.network}
+
+    def stats(self):
+        """ The cumulated cache statistics: 'hits' and 'misses' of cacheable packages, 'passthrough' requests
+            (indexes), and 'bytes_served_from_cache'
+        """
+        output = docker_exec('cat {}/stats.json'.format(CACHE_DIR), self.container, query=True)
+        try:
+            return json.loads(output)
+        except ValueError:
+            return {}
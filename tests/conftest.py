@@ -0,0 +1,14 @@
+# encoding: utf-8
+
+import pytest
+
+from .. import docker_basics, utils
+
+
+@pytest.fixture(autouse=True)
+def images_registry(tmpdir_factory, monkeypatch):
+    """ Keeps the images used by the tests out of the registry of the developer (see docker_basics.image_gc)
+    """
+    registry = utils.UsageRegistry(str(tmpdir_factory.mktemp('yadio').join('images.json')))
+    monkeypatch.setattr(docker_basics, 'images_registry', registry)
+    return registry
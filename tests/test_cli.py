@@ -0,0 +1,39 @@
+# encoding: utf-8
+
+import json
+
+import pytest
+
+from ..cli import main
+from ..docker_basics import disable_query_cache, namespaced
+
+
+@pytest.fixture
+def cli(tmpdir):
+    options = ['--socket', str(tmpdir.join('yadio.sock')), '--platforms', str(tmpdir.join('platforms.json'))]
+    yield lambda *args: main(options + list(args))
+    # the in process orchestrator enables the query cache
+    disable_query_cache()
+
+
+def test_platform(cli, capsys, tmpdir):
+    assert cli('platform', 'create', 'test', 'host1=testimage', '--network', 'testnet') == 0
+    assert capsys.readouterr()[0] == 'test\n'
+    assert cli('platform', 'list') == 0
+    assert json.loads(capsys.readouterr()[0]) == ['test']
+    assert json.loads(tmpdir.join('platforms.json').read())['test']['kwargs'] == {'network': 'testnet'}
+    assert cli('call', 'test', 'host_from_container', namespaced('testimage-test-host1')) == 0
+    assert capsys.readouterr()[0] == 'host1\n'
+    assert cli('call', 'test', 'host_from_container', 'unknown') == 1
+    assert 'not found' in capsys.readouterr()[1]
+    assert cli('platform', 'drop', 'test') == 0
+    assert capsys.readouterr()[0] == 'test\n'
+    assert cli('platform', 'list') == 0
+    assert json.loads(capsys.readouterr()[0]) == []
+
+
+def test_platform_name_required(cli, capsys, tmpdir):
+    for action in ('create', 'drop', 'setup', 'teardown'):
+        assert cli('platform', action) == 1
+        assert 'requires a platform name' in capsys.readouterr()[1]
+    assert not tmpdir.join('platforms.json').exists()
@@ -0,0 +1,63 @@
+# encoding: utf-8
+
+import threading
+
+import pytest
+
+from ..daemon import Client, Orchestrator, Server
+from ..docker_basics import namespaced
+from ..utils import ShellSession
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = Server(str(tmpdir.join('yadio.sock')), Orchestrator(str(tmpdir.join('platforms.json')), query_cache=False))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_shell_session():
+    session = ShellSession()
+    assert session.execute('pwd; cd /; pwd')[0].splitlines()[-1] == '/'
+    assert session.execute('echo error >&2; printf abc; exit 3') == ('abc', 'error\n', 3)
+    assert session.execute('echo $((1 + 1))') == ('2\n', '', 0)
+    session.close()
+    assert not session.alive()
+
+
+def test_daemon(server, tmpdir):
+    client = Client(server.path)
+    assert client.alive()
+    assert client.ping() == 'pong'
+    assert client.create_platform(name='test', images={'host1': 'testimage'}, network='testnet') == 'test'
+    assert client.list_platforms() == ['test']
+    assert client.call(platform='test', method='host_from_container',
+                       args=[namespaced('testimage-test-host1')]) == 'host1'
+    with pytest.raises(RuntimeError) as e:
+        client.call(platform='test', method='host_from_container', args=['unknown'])
+    assert 'LookupError' in str(e.value)
+    with pytest.raises(RuntimeError):
+        client.call(platform='test', method='_select')
+    with pytest.raises(RuntimeError):
+        client.unknown_method()
+    # platforms definitions are persistent
+    orchestrator = Orchestrator(str(tmpdir.join('platforms.json')), query_cache=False)
+    assert orchestrator.list_platforms() == ['test']
+    assert orchestrator.get_platform('test').network == namespaced('testnet')
+    assert client.drop_platform(name='test') == 'test'
+    assert client.list_platforms() == []
+    assert not Client(str(tmpdir.join('nodaemon.sock'))).alive()
+
+
+def test_daemon_execute(server):
+    client = Client(server.path)
+    client.create_platform(name='test', images={'host1': 'testimage', 'host2': 'testimage'})
+    client.call(platform='test', method='standard_setup')
+    assert client.execute(platform='test', cmd='hostname') == {'host1': namespaced('testimage-test-host1') + '\n',
+                                                               'host2': namespaced('testimage-test-host2') + '\n'}
+    assert client.execute(platform='test', cmd='pwd', host='host1') == '/\n'
+    assert client.stats()['sessions'] == 2
@@ -2,7 +2,8 @@
 
 import os.path
 
-from ..docker import PlatformManager, container_stop
+from ..docker import PlatformManager, DeployedPlatformManager, container_stop, get_networks, get_container_networks,\
+    get_containers, get_images_label, get_image_command, diff_processes
 
 ROOTDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -15,28 +16,60 @@ def test_build_delete_images():
     assert platform.get_real_images() == []
 
 
+def test_build_images_package_cache():
+    class Archive(object):
+        def __init__(self):
+            self.built = []
+
+        def load(self, image):
+            return image == 'archived'
+
+        def build(self, image, **options):
+            assert not self.load(image)
+            self.built.append((image, options))
+
+    class Cache(object):
+        started = 0
+
+        def build_options(self):
+            self.started += 1
+            return {'network': 'net'}
+
+    archive, cache = Archive(), Cache()
+    platform = PlatformManager('test', {'host1': 'archived'}, image_archive=archive, package_cache=cache)
+    platform.get_real_images = lambda: []
+    platform.build_images()
+    # the images loaded from the archive don't need the package cache
+    assert (archive.built, cache.started) == ([], 0)
+    platform = PlatformManager('test', {'host1': 'archived', 'host2': 'built'}, image_archive=archive,
+                               package_cache=cache)
+    platform.get_real_images = lambda: []
+    platform.build_images()
+    assert (archive.built, cache.started) == ([('built', {'network': 'net'})], 1)
+
+
 def test_run_stop_delete_containers():
     platform = PlatformManager('test', {'host': 'testimage'}).build_images()
     platform.run_containers(reset='rm_container')
-    assert platform.get_real_containers() == ['testimage-test-host']
+    assert platform.get_real_containers() == [platform.containers['host']]
     platform.containers_stop()
     assert platform.get_real_containers() == []
-    assert platform.get_real_containers(True) == ['testimage-test-host']
+    assert platform.get_real_containers(True) == [platform.containers['host']]
     platform.containers_delete()
     assert platform.get_real_containers(True) == []
 
 
 def test_get_hosts():
     with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
-        assert set(platform.get_real_containers()) == {'testimage-test-host1', 'testimage-test-host2'}
+        assert set(platform.get_real_containers()) == {platform.containers['host1'], platform.containers['host2']}
         hosts = platform.get_hosts()
         assert set(hosts.keys()) == {'host1', 'host2'}
-        assert '172.17.' in hosts['host1']
-        assert '172.17.' in hosts['host2']
-        container_stop('testimage-test-host2')
+        assert hosts['host1'].startswith('172.')
+        assert hosts['host2'].startswith('172.')
+        container_stop(platform.containers['host2'])
         hosts = platform.get_hosts()
         assert set(hosts.keys()) == {'host1', 'host2'}
-        assert '172.17.' in hosts['host1']
+        assert hosts['host1'].startswith('172.')
         assert '' == hosts['host2']
         try:
             platform.get_hosts(raises=True)
@@ -53,6 +86,20 @@ def test_network():
         assert platform.docker_exec('ping -c 1 {}'.format(platform.containers['host1']), 'host2', True)
 
 
+def test_multi_networks():
+    platform = PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'},
+                               networks={'host2': ['test-back']})
+    networks = {platform.network, platform.namespaced('test-back')}
+    with platform.standard_setup():
+        assert set(get_networks(networks)) == networks
+        assert get_container_networks(platform.containers['host1']) == [platform.network]
+        assert set(get_container_networks(platform.containers['host2'])) == networks
+        assert platform.get_hosts(raises=True)
+        platform.connect_network()
+    platform.reset('rm_container').teardown_network()
+    assert get_networks(networks) == []
+
+
 def test_docker_exec():
     with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
         assert platform.docker_exec('pwd') == {'host1': '/\n', 'host2': '/\n'}
@@ -65,11 +112,39 @@ def test_create_user():
         assert platform.docker_exec('groups toto') == {'host1': 'toto : toto\n', 'host2': 'toto : toto\n'}
 
 
+def test_batch():
+    with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
+        with platform.batch() as b:
+            b.run('mkdir /root/testdir')
+            b.run('hostname')
+        assert b.results['host1'][0].returncode == 0
+        assert b.results['host1'][1].stdout == platform.containers['host1'] + '\n'
+        assert b.results['host2'][1].stdout == platform.containers['host2'] + '\n'
+
+
 def test_put_get_data():
     with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
         platform.docker_exec('mkdir /root/testdir')
         platform.put_data('fluctuat nec mergitur', '/root/testdir/bob.txt')
-        assert platform.get_data('/root/testdir/bob.txt') == {'host1': 'fluctuat nec mergitur', 'host2': 'fluctuat nec mergitur'}
+        assert platform.get_data('/root/testdir/bob.txt') == {'host1': 'fluctuat nec mergitur',
+                                                              'host2': 'fluctuat nec mergitur'}
+
+
+def test_put_data_file():
+    with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
+        with open(os.path.join(ROOTDIR, 'dummy2.txt')) as f:
+            platform.put_data(f, '/root/dummy.txt')
+        platform.put_data(iter(['hello ', 'world']), '/root/hello.txt')
+        assert platform.get_data('/root/dummy.txt') == {'host1': 'hello world', 'host2': 'hello world'}
+        assert platform.get_data('/root/hello.txt') == {'host1': 'hello world', 'host2': 'hello world'}
+
+
+def test_get_data_dest(tmpdir):
+    with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
+        platform.put_data('fluctuat nec mergitur', '/root/bob.txt')
+        assert platform.get_data('/root/bob.txt', dest=str(tmpdir), tail=8) == {'host1': 8, 'host2': 8}
+        assert tmpdir.join('host1').read() == 'mergitur'
+        assert tmpdir.join('host2').read() == 'mergitur'
 
 
 def test_put_file():
@@ -89,6 +164,16 @@ def test_get_processes():
         assert processes['host2'] == platform.get_processes('host2')
 
 
+def test_process_snapshot():
+    with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
+        before = platform.process_snapshot()
+        assert set(before) == {'host1', 'host2'}
+        platform.docker_exec('/bin/bash -c "sleep 60 &"', 'host2')
+        diff = diff_processes(before, platform.process_snapshot(filter=lambda proc: proc.cmdline.startswith('sleep')))
+        assert [proc.cmdline for proc in diff['host2'][0]] == ['sleep 60']
+        assert diff['host1'][0] == []
+
+
 def test_ssh():
     with PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}).standard_setup() as platform:
         assert platform.ssh('pwd') == {'host1': '/root\n', 'host2': '/root\n'}
@@ -115,3 +200,163 @@ def test_put_file_exists():
         platform.docker_exec('rm -f /root/testdir/dummy2.txt', 'host1')
         assert platform.path_exists('/root/testdir/dummy2.txt', 'host2')
         assert not platform.path_exists('/root/testdir/dummy2.txt', 'host1')
+
+
+def test_namespaces():
+    platform1 = PlatformManager('test', {'host': 'testimage'}, namespace='ns1')
+    platform2 = PlatformManager('test', {'host': 'testimage'}, namespace='ns2')
+    assert platform1.containers == {'host': 'testimage-test-host-ns1'}
+    assert platform1.network == 'test-ns1'
+    platform1.standard_setup()
+    platform2.standard_setup()
+    assert platform1.get_real_containers() == ['testimage-test-host-ns1']
+    assert platform2.get_real_containers() == ['testimage-test-host-ns2']
+    assert platform1.docker_exec('hostname', 'host') == 'testimage-test-host-ns1\n'
+    platform1.cleanup_namespace()
+    assert get_containers('testimage-test-host-ns') == ['testimage-test-host-ns2']
+    assert get_networks(('test-ns1', 'test-ns2')) == ['test-ns2']
+    platform2.cleanup_namespace()
+    assert get_containers('testimage-test-host-ns') == []
+
+
+class FakeFabric(object):
+    deployed = 0
+
+    def set_platform(self, **kwargs):
+        pass
+
+    def deploy_from_scratch(self, *args):
+        self.deployed += 1
+
+    def register_platform(self, platform):
+        pass
+
+
+class SetupPlatformManager(PlatformManager):
+    def setup(self, reset=None):
+        self.reset(reset)
+        return self.standard_setup()
+
+
+def test_deployed_fingerprint():
+    fabric = FakeFabric()
+    platform = SetupPlatformManager('test', {'host': 'testimage'}).register_manager('fabric', fabric)
+    deployed = DeployedPlatformManager(platform, 'fabric', inputs={'version': 1}, distri='debian8')
+    deployed.reset('rm_image')
+    deployed.setup()
+    assert fabric.deployed == 1
+    fingerprint = deployed.fingerprint()
+    assert get_images_label(deployed.images_names, deployed.fingerprint_label) == \
+        {deployed.images['host']: fingerprint}
+    deployed.setup()
+    assert fabric.deployed == 1
+    deployed = DeployedPlatformManager(platform, 'fabric', inputs={'version': 2}, distri='debian8')
+    assert deployed.fingerprint() != fingerprint
+    deployed.setup()
+    assert fabric.deployed == 2
+    deployed.reset('rm_image')
+    platform.reset('rm_container').teardown_network()
+
+
+def test_tmpfs():
+    platform = PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'},
+                               common_tmpfs={'/data': '16m'}, tmpfs={'host2': {'/cache': None, '/root/.ssh': '1m'}})
+    with platform.standard_setup():
+        assert platform.docker_exec('df /data | grep -c tmpfs') == {'host1': '1\n', 'host2': '1\n'}
+        assert platform.docker_exec('df /cache | grep -c tmpfs', 'host2') == '1\n'
+        # a tmpfs is filled with the image content
+        assert platform.docker_exec('df /root/.ssh | grep -c tmpfs', 'host2') == '1\n'
+        assert platform.path_exists('/root/.ssh/authorized_keys', 'host2')
+        assert platform.docker_exec('stat -c %U:%a /root/.ssh', 'host2') == 'root:755\n'
+        platform.put_data('persisted', '/data/file.txt')
+        image = platform.namespaced('testimage-tmpfs')
+        platform.commit_containers({'host1': image, 'host2': image}, persist_tmpfs=True)
+    platform.reset('rm_container')
+    platform = PlatformManager('test', {'host': image}, common_tmpfs={'/data': '16m'})
+    with platform.standard_setup():
+        assert platform.get_data('/data/file.txt', 'host') == 'persisted'
+        # the committed image has the original command
+        assert get_image_command(image) == get_image_command('testimage')
+    platform.reset('rm_image')
+
+
+def test_replicas_select():
+    platform = PlatformManager('test', {'db': 'testimage', 'worker': 'testimage'}, replicas={'worker': 3},
+                               parameters={'worker': '-e ROLE=worker'})
+    assert platform.roles == {'db': ['db'], 'worker': ['worker-1', 'worker-2', 'worker-3']}
+    assert platform.containers['worker-2'] == platform.namespaced('testimage-test-worker-2')
+    assert platform.parameters['worker-3'].strip() == '-e ROLE=worker'
+    assert platform.select('worker-1') == {'worker-1': platform.containers['worker-1']}
+    assert sorted(platform.select('worker')) == ['worker-1', 'worker-2', 'worker-3']
+    assert sorted(platform.select()) == ['db', 'worker-1', 'worker-2', 'worker-3']
+    try:
+        platform.select('worker-4')
+        assert 0, "Should raise a LookupError"
+    except LookupError:
+        pass
+
+
+def test_replicas():
+    platform = PlatformManager('test', {'db': 'testimage', 'worker': 'testimage'}, replicas={'worker': 3})
+    with platform.standard_setup():
+        assert len(platform.get_real_containers()) == 4
+        assert platform.docker_exec('hostname', 'worker-2') == platform.containers['worker-2'] + '\n'
+        assert sorted(platform.docker_exec('hostname', 'worker')) == ['worker-1', 'worker-2', 'worker-3']
+        platform.put_data('data', '/root/file.txt', 'worker-3')
+        platform.scale('worker', 5)
+        assert len(platform.get_real_containers()) == 6
+        assert platform.get_data('/root/file.txt', 'worker-3') == 'data'
+        platform.scale('worker', 1)
+        assert sorted(platform.get_real_containers(True)) == sorted(platform.select().values())
+        assert sorted(platform.get_hosts(raises=True)) == ['db', 'worker-1']
+    platform.reset('rm_container').teardown_network()
+
+
+def test_lazy_select():
+    platform = PlatformManager('test', {'db': 'testimage', 'worker': 'testimage'}, replicas={'worker': 2}, lazy=True)
+    started = []
+    platform.start_hosts = lambda hosts: started.append(sorted(hosts))
+    platform.run_containers()
+    assert started == []
+    assert platform.container('worker-2') == platform.namespaced('testimage-test-worker-2')
+    assert platform.select('worker-2') == {'worker-2': platform.containers['worker-2']}
+    platform.materialize('worker')
+    platform.scale('worker', 3)
+    platform.materialize()
+    assert started == [['worker-2'], ['worker-1'], ['db', 'worker-3']]
+
+
+def test_scale_failure(monkeypatch):
+    from .. import docker
+    platform = PlatformManager('test', {'worker': 'testimage'}, replicas={'worker': 4})
+    existing = set(platform.containers.values())
+    stuck = platform.containers['worker-3']
+
+    def container_delete(container):
+        if container != stuck:
+            existing.discard(container)
+            return True
+
+    monkeypatch.setattr(docker, 'container_stop', lambda container: False)
+    monkeypatch.setattr(docker, 'container_delete', container_delete)
+    monkeypatch.setattr(docker, 'get_containers', lambda filter: [k for k in filter if k in existing])
+    try:
+        platform.scale('worker', 1)
+        assert 0, "Should raise a RuntimeError"
+    except RuntimeError as e:
+        assert 'worker-3' in str(e)
+    # the stopped but undeleted container is still tracked
+    assert platform.roles['worker'] == ['worker-1', 'worker-3']
+    assert sorted(platform.containers) == ['worker-1', 'worker-3']
+    assert platform.replicas['worker'] == 2
+
+
+def test_lazy():
+    platform = PlatformManager('test', {'host1': 'testimage', 'host2': 'testimage'}, lazy=True)
+    with platform.standard_setup():
+        assert platform.get_real_containers(True) == []
+        assert platform.docker_exec('hostname', 'host1') == platform.containers['host1'] + '\n'
+        assert platform.get_real_containers() == [platform.containers['host1']]
+        platform.materialize()
+        assert sorted(platform.get_hosts(raises=True)) == ['host1', 'host2']
+    platform.reset('rm_container').teardown_network()
@@ -1,10 +1,17 @@
 # encoding: utf-8
 
 import glob
+import pipes
+
+import pytest
 
 from ..docker_basics import *
+from .. import utils
 
 image = 'testimage'
+# names of the containers and images created by the tests, namespaced to run in parallel workers
+toto, titi = namespaced('toto'), namespaced('titi')
+gc_image = namespaced('testimage-gc')
 data = \
 """ligne 1
 ligne 2
@@ -14,10 +21,10 @@ ligne 2
 
 
 def basic_setup():
-    container_stop('toto')
-    container_delete('toto')
+    container_stop(toto)
+    container_delete(toto)
     docker_build(image)
-    docker_run(image, 'toto')
+    docker_run(image, toto)
 
 
 def test_docker_build():
@@ -36,27 +43,27 @@ def test_get_images():
 
 def test_get_containers():
     docker_build(image)
-    container_stop('toto', 'titi')
-    container_delete('toto', 'titi')
-    docker_run(image, 'toto')
-    docker_run(image, 'titi')
-    assert get_containers('toto') == ['toto']
-    assert get_containers('toto', all=False) == ['toto']
-    assert get_containers(('toto', )) == ['toto']
-    assert set(get_containers(image=image)).issuperset(('toto', 'titi'))
-    container_stop('toto', 'titi')
-    assert get_containers('toto', all=False) == []
-    assert get_containers('toto') == ['toto']
-    container_delete('toto', 'titi')
-    assert get_containers('toto') == []
+    container_stop(toto, titi)
+    container_delete(toto, titi)
+    docker_run(image, toto)
+    docker_run(image, titi)
+    assert get_containers(toto) == [toto]
+    assert get_containers(toto, all=False) == [toto]
+    assert get_containers((toto, )) == [toto]
+    assert set(get_containers(image=image)).issuperset((toto, titi))
+    container_stop(toto, titi)
+    assert get_containers(toto, all=False) == []
+    assert get_containers(toto) == [toto]
+    container_delete(toto, titi)
+    assert get_containers(toto) == []
 
 
 def test_docker_exec():
     basic_setup()
-    assert docker_exec('pwd', 'toto') == '/\n'
-    assert docker_exec('pwd', 'toto', status_only=True)
-    assert docker_exec('wtf', 'toto', status_only=True) is False
-    result = docker_exec('pwd', 'toto', stdout_only=False)
+    assert docker_exec('pwd', toto) == '/\n'
+    assert docker_exec('pwd', toto, status_only=True)
+    assert docker_exec('wtf', toto, status_only=True) is False
+    result = docker_exec('pwd', toto, stdout_only=False)
     assert result.returncode == 0
     assert result.stdout.strip() == '/'
     assert result.stderr.strip() == ''
@@ -64,27 +71,44 @@ def test_docker_exec():
 
 def test_docker_exec_user():
     basic_setup()
-    assert docker_exec('touch /root/toto', 'toto', status_only=True)
-    assert docker_exec('ls -al /root | grep toto', 'toto').startswith(('-rw-r--r--  1 root root'))
-    assert docker_exec('mkdir -p /var/www', 'toto', status_only=True)
-    assert path_set_user('/var/www', 'www-data', 'toto', 'www-data')
-    assert docker_exec('touch /var/www/titi', 'toto', user='www-data', status_only=True)
-    assert docker_exec('ls -al /var/www | grep titi', 'toto').startswith(('-rw-r--r--  1 www-data www-data'))
+    assert docker_exec('touch /root/toto', toto, status_only=True)
+    assert docker_exec('ls -al /root | grep toto', toto).startswith(('-rw-r--r--  1 root root'))
+    assert docker_exec('mkdir -p /var/www', toto, status_only=True)
+    assert path_set_user('/var/www', 'www-data', toto, 'www-data')
+    assert docker_exec('touch /var/www/titi', toto, user='www-data', status_only=True)
+    assert docker_exec('ls -al /var/www | grep titi', toto).startswith(('-rw-r--r--  1 www-data www-data'))
 
 
 def test_path_exists():
     basic_setup()
-    assert not path_exists('/root/a/b', 'toto')
-    docker_exec('mkdir -p /root/a/b', 'toto')
-    assert path_exists('/root/a/b', 'toto')
+    assert not path_exists('/root/a/b', toto)
+    docker_exec('mkdir -p /root/a/b', toto)
+    assert path_exists('/root/a/b', toto)
 
 
 def test_put_data():
     basic_setup()
-    put_data(data, '/root/data.txt', 'toto')
-    assert get_data('/root/data.txt', 'toto') == data
-    put_data(data, '/root/data.txt', 'toto', append=True)
-    assert get_data('/root/data.txt', 'toto') == data + data
+    put_data(data, '/root/data.txt', toto)
+    assert get_data('/root/data.txt', toto) == data
+    put_data(data, '/root/data.txt', toto, append=True)
+    assert get_data('/root/data.txt', toto) == data + data
+
+
+def test_get_data_range(tmpdir):
+    basic_setup()
+    put_data('0123456789', '/root/data.txt', toto)
+    assert get_data('/root/data.txt', toto, offset=2, length=3) == '234'
+    assert get_data('/root/data.txt', toto, tail=4) == '6789'
+    assert list(iter_data('/root/data.txt', toto, chunk_size=4)) == ['0123', '4567', '89']
+    dest = str(tmpdir.join('data.txt'))
+    assert get_data('/root/data.txt', toto, dest) == 10
+    with open(dest) as f:
+        assert f.read() == '0123456789'
+    assert get_data('/root/data.txt', toto, tail=0) == ''
+    missing = str(tmpdir.join('missing.txt'))
+    with pytest.raises(RuntimeError):
+        get_data('/root/missing.txt', toto, missing)
+    assert tmpdir.listdir() == [tmpdir.join('data.txt')]
 
 
 def test_put_file():
@@ -93,42 +117,164 @@ def test_put_file():
     with open(file, 'r') as f:
         data = f.read()
     # check full file path
-    put_file(file, '/root/dummy.txt', 'toto')
-    assert data == get_data('/root/dummy.txt', 'toto')
+    put_file(file, '/root/dummy.txt', toto)
+    assert data == get_data('/root/dummy.txt', toto)
     # check directory path
-    put_file(file, '/root', 'toto')
-    assert data == get_data('/root/dummy1.txt', 'toto')
+    put_file(file, '/root', toto)
+    assert data == get_data('/root/dummy1.txt', toto)
 
 
 def test_create_user():
     basic_setup()
-    create_user('toto', 'toto')
-    assert docker_exec('groups toto', 'toto') == 'toto : toto\n'
-    create_user('titi', 'toto', ('group1', 'group2'))
-    assert docker_exec('groups titi', 'toto') == 'titi : titi group1 group2\n'
+    create_user('toto', toto)
+    assert docker_exec('groups toto', toto) == 'toto : toto\n'
+    create_user('titi', toto, ('group1', 'group2'))
+    assert docker_exec('groups titi', toto) == 'titi : titi group1 group2\n'
+
+
+def test_batch_script():
+    b = Batch().run('pwd').run('echo error >&2; false').run('printf abc; exit 3')
+    script = b.script('MARK')
+    dock = utils.Command('cd / && /bin/bash -s', datain=script)
+    assert Batch.parse(dock.stdout, 'MARK', 3) == [('/\n', 0), ('', 1), ('abc', 3)]
+    assert Batch.parse(dock.stderr, 'MARK', 3) == [('', 0), ('error\n', 1), ('', 3)]
+    b.stop_on_error = True
+    dock = utils.Command('/bin/bash -s', datain=b.script('MARK'))
+    assert [ret for _, ret in Batch.parse(dock.stdout, 'MARK', 3)] == [0, 1]
+
+
+def test_batch_replay(tmpdir):
+    path = str(tmpdir.join('record.jsonl'))
+    with utils.recording(path) as recorder:
+        b = Batch().run('pwd').run('printf abc; exit 3')
+        # executed locally, recorded as if executed on a container
+        dock = utils.Command('cd / && /bin/bash -s', datain=b.script(b.marker()))
+        recorder.record('docker exec -i  {} /bin/bash -s'.format(toto), 0, dock.stdout, dock.stderr, 0, 0)
+    with utils.replaying(path, scale=0):
+        with batch(toto) as b:
+            b.run('pwd')
+            b.run('printf abc; exit 3')
+    assert [(r.stdout, r.returncode) for r in b.results] == [('/\n', 0), ('abc', 3)]
+
+
+def test_tmpfs_init_script(tmpdir, monkeypatch):
+    from .. import docker_basics
+    monkeypatch.setattr(docker_basics, 'TMPFS_SEEDS', str(tmpdir.join('seeds')))
+    monkeypatch.setattr(docker_basics, 'TMPFS_ARCHIVES', str(tmpdir.join('archives')))
+    seeded, archived = str(tmpdir.mkdir('seeded')), str(tmpdir.mkdir('archived'))
+    seed = tmpdir.join('seeds', seeded)
+    seed.ensure('sub', 'file.txt').write('from image')
+    seed.chmod(0700)
+    tmpdir.mkdir('archive').join('file.txt').write('from archive')
+    tmpdir.mkdir('archives')
+    utils.command('tar cf {} -C {} .'.format(docker_basics._tmpfs_archive(archived), tmpdir.join('archive')))
+    script = tmpfs_init_script({seeded: '16m', archived: None})
+    dock = utils.Command('sh -c {} yadio-tmpfs echo started'.format(pipes.quote(script)))
+    assert (dock.stdout, dock.returncode) == ('started\n', 0)
+    assert tmpdir.join('seeded', 'sub', 'file.txt').read() == 'from image'
+    assert oct(tmpdir.join('seeded').stat().mode & 0777) == '0700'
+    assert tmpdir.join('archived', 'file.txt').read() == 'from archive'
+    # the image content is not kept in the container
+    assert not tmpdir.join('seeds').check()
+
+
+def test_tmpfs_entrypoint():
+    with pytest.raises(ValueError):
+        docker_run('testimage', 'test-tmpfs', parameters='-e A=1 --entrypoint /bin/bash', tmpfs={'/data': None})
+
+
+def test_batch():
+    basic_setup()
+    with batch(toto) as b:
+        b.run('pwd')
+        b.run('cat /nonexistent')
+    assert [r.returncode for r in b.results] == [0, 1]
+    assert b.results[0].stdout == '/\n'
+    assert 'No such file' in b.results[1].stderr
+    with pytest.raises(RuntimeError):
+        with batch(toto, raises=True) as b:
+            b.run('false')
 
 
 def test_set_user_permissions():
     basic_setup()
     file = os.path.join(ROOTDIR, 'tests/dummy1.txt')
-    put_file(file, '/root/dummy.txt', 'toto')
-    assert docker_exec('ls -al /root | grep dummy', 'toto').startswith(('-rw-rw-r--  1 root root'))
-    assert path_set_user('/root/dummy.txt', 'www-data', 'toto')
-    assert docker_exec('ls -al /root | grep dummy', 'toto').startswith(('-rw-rw-r--  1 www-data root'))
-    assert path_set_user('/root/dummy.txt', 'www-data', 'toto', group='www-data')
-    assert docker_exec('ls -al /root | grep dummy', 'toto').startswith(('-rw-rw-r--  1 www-data www-data'))
-    assert set_permissions('/root/dummy.txt', '0744', 'toto')
-    assert docker_exec('ls -al /root | grep dummy', 'toto').startswith(('-rwxr--r--  1 www-data www-data'))
+    put_file(file, '/root/dummy.txt', toto)
+    assert docker_exec('ls -al /root | grep dummy', toto).startswith(('-rw-rw-r--  1 root root'))
+    assert path_set_user('/root/dummy.txt', 'www-data', toto)
+    assert docker_exec('ls -al /root | grep dummy', toto).startswith(('-rw-rw-r--  1 www-data root'))
+    assert path_set_user('/root/dummy.txt', 'www-data', toto, group='www-data')
+    assert docker_exec('ls -al /root | grep dummy', toto).startswith(('-rw-rw-r--  1 www-data www-data'))
+    assert set_permissions('/root/dummy.txt', '0744', toto)
+    assert docker_exec('ls -al /root | grep dummy', toto).startswith(('-rwxr--r--  1 www-data www-data'))
 
 
 def test_put_directory():
     basic_setup()
-    put_directory('.', '/root/subdir', 'toto')
+    put_directory('.', '/root/subdir', toto)
     for file in glob.glob('*'):
-        assert path_exists(os.path.join('/root/subdir', file), 'toto')
+        assert path_exists(os.path.join('/root/subdir', file), toto)
 
 
 def test_get_processes():
     basic_setup()
-    assert get_processes('toto')
-    assert get_processes('toto', 'sshd')
+    assert get_processes(toto)
+    assert get_processes(toto, 'sshd')
+
+
+def test_query_cache():
+    basic_setup()
+    cache = enable_query_cache()
+    try:
+        processes = get_processes(toto)
+        assert get_processes(toto) == processes
+        assert (cache.hits, cache.misses) == (1, 1)
+        docker_exec('touch /root/toto', toto)
+        assert get_processes(toto) == processes
+        assert (cache.hits, cache.misses) == (1, 2)
+    finally:
+        disable_query_cache()
+
+
+def test_image_gc(images_registry):
+    # images_registry is a temporary registry (see conftest), gc must not touch the developer images
+    basic_setup()
+    docker_commit(toto, gc_image)
+    assert set(images_registry.usage()) == {'testimage', gc_image}
+    sizes = get_images_sizes([gc_image, 'testimage', 'nonexistent'])
+    assert set(sizes) == {gc_image, 'testimage'}
+    report = image_gc(0, dry_run=True, registry=images_registry)
+    assert 'testimage' in report['in_use']
+    assert (gc_image, sizes[gc_image]) in [x[:2] for x in report['evicted']]
+    assert get_images(gc_image) == [gc_image]
+    image_gc(0, registry=images_registry)
+    assert get_images(gc_image) == []
+    assert gc_image not in images_registry.usage()
+
+
+def test_parse_process_table():
+    output = utils.Command('/bin/bash -s', datain=PROCESS_TABLE_SCRIPT).stdout
+    processes = parse_process_table(output)
+    me = [proc for proc in processes if proc.pid == os.getpid()]
+    assert len(me) == 1
+    assert me[0].ppid == os.getppid()
+    assert 'python' in me[0].cmdline
+    assert me[0].rss > 0
+    # the processes of the script are excluded
+    assert not [proc for proc in processes if proc.cmdline.startswith(('cat', 'awk', 'tr'))]
+    output = '100\n4096\n50 51\n0\t1 (my init) S 0 1 1 0 -1 4194560 1 2 3 4 150 50 0 0 20 0 1 0 5 6 ' \
+             '10 18446744073709551615\t/sbin/init --flag\n1000\t7 (kworker) S 2 0 0 0 -1 0 0 0 0 0 0 0 0 0 ' \
+             '20 0 1 0 5 0 0 0\t\n\nroot:x:0:0:root:/root:/bin/bash\n'
+    assert parse_process_table(output) == [Process(1, 0, 'root', '/sbin/init --flag', 2., 40960),
+                                           Process(7, 2, '1000', '[kworker]', 0., 0)]
+
+
+def test_get_process_table():
+    basic_setup()
+    before = get_process_table(toto)
+    assert [proc for proc in before if proc.pid == 1][0].cmdline == '/usr/sbin/sshd -D'
+    assert get_process_table(toto, lambda proc: proc.user != 'root') == []
+    docker_exec('/bin/bash -c "sleep 60 &"', toto)
+    started, ended = diff_processes(before, get_process_table(toto))
+    assert [proc.cmdline for proc in started] == ['sleep 60']
+    assert ended == []
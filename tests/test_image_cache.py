@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+import os
+import time
+
+from ..docker_basics import image_delete_and_containers, get_images
+from .. import image_cache
+from ..image_cache import base_images, build_inputs, build_key, ImageArchive
+
+
+def make_context(tmpdir):
+    tmpdir.mkdir('img').join('Dockerfile').write('FROM debian:8\nCOPY keys/key.pub /root/\nADD ["conf", "/etc/"]\n')
+    tmpdir.mkdir('keys').join('key.pub').write('key')
+    conf = tmpdir.mkdir('conf')
+    conf.join('a.conf').write('a')
+    conf.mkdir('sub').join('b.conf').write('b')
+    tmpdir.join('unused.txt').write('unused')
+    return str(tmpdir)
+
+
+def test_build_inputs(tmpdir):
+    context = make_context(tmpdir)
+    assert build_inputs('img', context) == ['conf/a.conf', 'conf/sub/b.conf', 'img/Dockerfile', 'keys/key.pub']
+    assert build_inputs('testimage') == ['keys/unsecure_key.pub', 'testimage/Dockerfile']
+
+
+def test_build_key(tmpdir):
+    context = make_context(tmpdir)
+    key = build_key('img', context=context)
+    assert build_key('img', context=context) == key
+    assert build_key('img', 'tag', context) != key
+    labelled = build_key('img', context=context, labels={'yadio.namespace': 'ns1'})
+    assert labelled != key
+    assert build_key('img', context=context, labels={'yadio.namespace': 'ns2'}) != labelled
+    tmpdir.join('unused.txt').write('changed')
+    assert build_key('img', context=context) == key
+    tmpdir.join('conf', 'sub', 'b.conf').write('changed')
+    assert build_key('img', context=context) != key
+
+
+def test_build_key_base_images(tmpdir, monkeypatch):
+    tmpdir.mkdir('img').join('Dockerfile').write('FROM --platform=linux/amd64 debian:8 AS builder\n'
+                                                  'RUN true\nFROM builder\n# comment\n'
+                                                  'COPY a \\\n  # comment in a continuation\n  b /\n')
+    tmpdir.join('a').write('a')
+    tmpdir.join('b').write('b')
+    context = str(tmpdir)
+    assert base_images('img', context) == ['debian:8']
+    assert build_inputs('img', context) == ['a', 'b', 'img/Dockerfile']
+    ids = {}
+    monkeypatch.setattr(image_cache, 'get_images_ids', lambda images: {k: ids[k] for k in images if k in ids})
+    key = build_key('img', context=context)
+    ids['debian:8'] = 'sha256:1'
+    pulled = build_key('img', context=context)
+    assert pulled != key
+    ids['debian:8'] = 'sha256:2'
+    assert build_key('img', context=context) != pulled
+
+
+def test_evict(tmpdir):
+    archive = ImageArchive(str(tmpdir), max_size=25)
+    now = time.time()
+    for i, name in enumerate(('old', 'middle', 'recent')):
+        path = tmpdir.join(name + '.tar')
+        path.write('x' * 10)
+        os.utime(str(path), (now + i, now + i))
+    assert [os.path.basename(x[0]) for x in archive.archives()] == ['old.tar', 'middle.tar', 'recent.tar']
+    assert archive.evict() == [str(tmpdir.join('old.tar'))]
+    assert archive.evict() == []
+
+
+def test_archive_build(tmpdir):
+    archive = ImageArchive(str(tmpdir))
+    image_delete_and_containers('testimage')
+    assert not archive.load('testimage')
+    assert archive.build('testimage')
+    assert len(archive.archives()) == 1
+    image_delete_and_containers('testimage')
+    assert archive.load('testimage')
+    assert get_images('testimage') == ['testimage']
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+import BaseHTTPServer
+import imp
+import json
+import os
+import threading
+import urllib2
+
+import pytest
+
+from .. import ROOTDIR
+from ..docker_basics import namespaced
+from ..package_cache import PackageCache
+
+pkgcache = imp.load_source('pkgcache', os.path.join(ROOTDIR, 'images', 'pkgcache', 'pkgcache.py'))
+
+
+class Upstream(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in for a debian mirror, pypi and its files host
+    """
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        base = 'http://{}:{}'.format(*self.server.server_address)
+        content = {'/debian/dists/jessie/Release': 'release',
+                   '/debian/pool/main/f/foo/foo_1.0_all.deb': 'deb content',
+                   '/simple/foo/': '<a href="{}/packages/foo-1.0.tar.gz#sha256=0">foo-1.0.tar.gz</a>'.format(base),
+                   '/packages/foo-1.0.tar.gz': 'sdist content'}.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://{}:{}'.format(*server.server_address)
+
+
+@pytest.fixture
+def proxy(tmpdir):
+    upstream = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Upstream)
+    upstream_url = serve(upstream)
+    server = pkgcache.Server(('127.0.0.1', 0), str(tmpdir), upstream_url, upstream_url)
+    del Upstream.requests[:]
+    yield upstream_url, serve(server), server
+    server.shutdown()
+    server.server_close()
+    upstream.shutdown()
+    upstream.server_close()
+
+
+def test_apt_proxy(proxy):
+    upstream_url, proxy_url, server = proxy
+    opener = urllib2.build_opener(urllib2.ProxyHandler({'http': proxy_url}))
+    for _ in range(3):
+        assert opener.open(upstream_url + '/debian/dists/jessie/Release').read() == 'release'
+        assert opener.open(upstream_url + '/debian/pool/main/f/foo/foo_1.0_all.deb').read() == 'deb content'
+    assert Upstream.requests.count('/debian/dists/jessie/Release') == 3
+    assert Upstream.requests.count('/debian/pool/main/f/foo/foo_1.0_all.deb') == 1
+    with pytest.raises(urllib2.HTTPError) as e:
+        opener.open(upstream_url + '/debian/pool/main/b/bar/bar_1.0_all.deb')
+    assert e.value.code == 404
+    stats = json.loads(urllib2.urlopen(proxy_url + '/_stats').read())
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['passthrough'] == 3
+    assert stats['bytes_served_from_cache'] == 2 * len('deb content')
+
+
+def test_pip_index(proxy, tmpdir):
+    upstream_url, proxy_url, server = proxy
+    page = urllib2.urlopen(proxy_url + '/pypi/simple/foo/').read()
+    link = page.split('"')[1]
+    assert link.startswith(proxy_url + '/pypi/files/packages/foo-1.0.tar.gz')
+    assert urllib2.urlopen(link).read() == 'sdist content'
+    assert urllib2.urlopen(link).read() == 'sdist content'
+    assert Upstream.requests == ['/simple/foo/', '/packages/foo-1.0.tar.gz']
+    # statistics are kept across restarts
+    assert json.loads(tmpdir.join('stats.json').read())['hits'] == 1
+    assert pkgcache.Cache(str(tmpdir)).stats['hits'] == 1
+
+
+def test_package_cache():
+    cache = PackageCache(container=namespaced('test-pkgcache'), volume=namespaced('test-pkgcache'))
+    try:
+        ip = cache.start()
+        assert cache.running()
+        assert cache.start() == ip
+        options = cache.build_options()
+        assert options['network'] is None
+        assert options['build_args']['PIP_INDEX_URL'] == 'http://{}:3142/pypi/simple/'.format(ip)
+        assert options['build_args']['http_proxy'] == 'http://{}:3142'.format(ip)
+        assert set(cache.stats()) == {'hits', 'misses', 'passthrough', 'bytes_served_from_cache'}
+    finally:
+        cache.stop()
@@ -1,9 +1,14 @@
 # encoding: utf-8
 
+import json
+import mmap
 import os.path
 import pytest
+import time
 
-from ..utils import cd, extract_column, filter_column, command, Command, Sequencer
+from ..utils import cd, extract_column, filter_column, command, Command, Sequencer, command_stream, parallel_map,\
+    command_input, iter_chunks, QueryCache, operation_type, AdaptiveLimiter, set_governor,\
+    UsageRegistry, recording, replaying, Step
 
 ROOTDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -88,3 +93,257 @@ def test_sequencer():
     t = Toto()
     t.run_sequence(('a', ('b', 'x')))
     assert t.l == ['a', ('b', 'x')]
+
+
+def test_command_stream():
+    assert list(command_stream('printf abcdefgh', chunk_size=3)) == ['abc', 'def', 'gh']
+    assert list(command_stream('true')) == []
+    with pytest.raises(RuntimeError):
+        list(command_stream('fancycommand', raises=True))
+    stream = command_stream('yes', chunk_size=4)
+    assert next(stream) == 'y\ny\n'
+    stream.close()
+
+
+def test_parallel_map():
+    assert parallel_map(lambda x: x * 2, range(10), workers=4) == [x * 2 for x in range(10)]
+    assert parallel_map(lambda x: x, []) == []
+
+    def fails(x):
+        raise ValueError(x)
+    with pytest.raises(ValueError):
+        parallel_map(fails, range(3))
+
+
+def test_iter_chunks(tmpdir):
+    assert list(iter_chunks('abcdefgh', 3)) == ['abc', 'def', 'gh']
+    assert list(iter_chunks(iter(['ab', 'cd']))) == ['ab', 'cd']
+    source = tmpdir.join('source.txt')
+    source.write('abcdefgh')
+    with source.open() as f:
+        assert list(iter_chunks(f, 5)) == ['abcde', 'fgh']
+
+
+def test_command_input(tmpdir):
+    source = tmpdir.join('source.txt')
+    source.write('x' * 1000000)
+    dest = tmpdir.join('dest.txt')
+    cmd = 'cat > {}'.format(dest)
+    assert command_input(cmd, 'hello') == 0
+    assert dest.read() == 'hello'
+    assert command_input(cmd, iter(['hello ', 'world'])) == 0
+    assert dest.read() == 'hello world'
+    with source.open() as f:
+        assert command_input(cmd, f, chunk_size=4096) == 0
+    assert dest.read() == source.read()
+    with source.open() as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert command_input(cmd, m) == 0
+        m.close()
+    assert dest.read() == source.read()
+    # the command does not read its input
+    assert command_input('exit 3', source.read()) == 3
+    with pytest.raises(RuntimeError):
+        command_input('exit 3', 'hello', raises=True)
+    # a command writing a lot is not blocked by its outputs
+    assert command_input('head -c 10000000 /dev/zero; cat >/dev/null', 'hello') == 0
+
+    def failing():
+        yield 'hello'
+        raise ValueError('unreadable')
+
+    # a failing input kills the command
+    start = time.time()
+    with pytest.raises(ValueError):
+        command_input('cat >/dev/null; sleep 10', failing())
+    assert time.time() - start < 5
+
+
+def test_query_cache():
+    calls = []
+
+    def query(value):
+        def func():
+            calls.append(value)
+            return value
+        return func
+    cache = QueryCache(ttl=0.2, maxsize=2)
+    assert cache.get('c1', 'a', query(1)) == 1
+    assert cache.get('c1', 'a', query(2)) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.get('c2', 'a', query(3))
+    cache.get('c1', 'a', query(4))
+    # LRU eviction of ('c2', 'a')
+    cache.get('c1', 'b', query(5))
+    assert cache.get('c2', 'a', query(6)) == 6
+    # invalidation by scope
+    cache.invalidate('c1')
+    assert cache.get('c1', 'a', query(7)) == 7
+    assert cache.get('c2', 'a', query(8)) == 6
+    # expiration
+    time.sleep(0.2)
+    assert cache.get('c2', 'a', query(9)) == 9
+    assert calls == [1, 3, 5, 6, 7, 9]
+    assert cache.stats() == {'hits': 3, 'misses': 6, 'size': 2}
+    # a value computed during an invalidation of its scope is not cached
+    cache.get('c3', 'a', lambda: cache.invalidate('c3'))
+    assert cache.get('c3', 'a', query(10)) == 10
+
+
+def test_operation_type():
+    assert operation_type('docker build -f x/Dockerfile -t x .') == 'heavy'
+    assert operation_type('docker run -d --name x image') == 'heavy'
+    assert operation_type('tar zc * | docker exec -i x tar zx -C /root') == 'light'
+    assert operation_type("docker inspect --format '{{ .Id }}' x") == 'light'
+    assert operation_type('ssh root@host pwd') is None
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=5)
+    for _ in range(20):
+        limiter.update(0.01)
+    assert int(limiter.limit) == 5
+    limiter.update(1.)
+    assert int(limiter.limit) == 2
+    # at most one decrease per latency period
+    limiter.update(1.)
+    assert int(limiter.limit) == 2
+
+
+def test_governor():
+    gov = set_governor()
+    limiter = gov.limiters['light']
+    limiter.limit = limiter.maximum = 2.
+    try:
+        parallel_map(lambda _: command('docker version >/dev/null 2>&1; sleep 0.1'), range(6), workers=6)
+        stats = gov.stats()['light']
+        assert stats['count'] == 6
+        assert stats['queued'] >= 4
+        assert stats['max_wait'] >= 0.1
+        assert gov.stats()['heavy']['count'] == 0
+        command('true')
+        assert gov.stats()['light']['count'] == 6
+    finally:
+        set_governor(None)
+
+
+def test_governor_stream():
+    gov = set_governor()
+    limiter = gov.limiters['light']
+    limiter.limit = limiter.minimum = limiter.maximum = 1
+    try:
+        stream = command_stream('echo docker version; echo done', chunk_size=1)
+        assert next(stream) == 'd'
+        # the slot is released while the stream is consumed
+        assert limiter.stats()['in_flight'] == 0
+        command('docker version >/dev/null 2>&1')
+        time.sleep(0.2)
+        assert ''.join(stream) == 'ocker version\ndone\n'
+        assert limiter.stats()['count'] == 2
+    finally:
+        set_governor(None)
+
+
+def test_command_stream_chunks():
+    # the producer is slower than the consumer, chunks keep their size
+    assert list(command_stream('printf ab; sleep 0.2; printf cdefgh', chunk_size=4)) == ['abcd', 'efgh']
+    assert list(command_stream('printf ab; sleep 0.2; printf c', chunk_size=4)) == ['abc']
+    assert list(command_stream('true', chunk_size=4)) == []
+
+
+def test_usage_registry(tmpdir):
+    registry = UsageRegistry(str(tmpdir.join('sub', 'usage.json')))
+    assert registry.usage() == {}
+    registry.touch('a', 'b')
+    usage = registry.usage()
+    assert set(usage) == {'a', 'b'}
+    time.sleep(0.01)
+    registry.touch('a')
+    assert registry.usage()['a'] > usage['a']
+    registry.refresh('b', 'c')
+    assert registry.usage()['b'] > usage['b']
+    assert 'c' not in registry.usage()
+    parallel_map(registry.touch, [str(i) for i in range(20)])
+    registry.forget('a', 'c')
+    assert set(UsageRegistry(registry.path).usage()) == {'b'}.union(str(i) for i in range(20))
+
+
+def test_record_replay(tmpdir):
+    path = str(tmpdir.join('record.jsonl'))
+    dest = tmpdir.join('dest.txt')
+    with recording(path):
+        assert Command('echo hello; echo world >&2').stdout == 'hello\n'
+        assert command('exit 2') == 2
+        assert command_input('cat > {}'.format(dest), 'data') == 0
+        assert list(command_stream('printf abcd', chunk_size=2)) == ['ab', 'cd']
+        Command('sleep 0.2')
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [e['cmd'] for e in entries][:2] == ['echo hello; echo world >&2', 'exit 2']
+    assert entries[2]['stdin_size'] == 4
+    assert entries[4]['latency'] >= 0.2
+    dest.remove()
+    with replaying(path, scale=0.):
+        com = Command('echo hello; echo world >&2')
+        assert (com.stdout, com.stderr, com.returncode) == ('hello\n', 'world\n', 0)
+        assert command('exit 2') == 2
+        with pytest.raises(RuntimeError):
+            command('exit 2', raises=True)
+        assert command_input('cat > {}'.format(dest), 'data') == 0
+        assert list(command_stream('printf abcd', chunk_size=3)) == ['abc', 'd']
+        start = time.time()
+        Command('sleep 0.2')
+        assert time.time() - start < 0.1
+        with pytest.raises(LookupError):
+            Command('pwd')
+    # nothing was executed
+    assert not dest.exists()
+    with replaying(path, scale=0.5):
+        start = time.time()
+        Command('sleep 0.2')
+        assert 0.1 <= time.time() - start < 0.2
+
+
+def test_sequencer_steps():
+    class Toto(Sequencer):
+        def __init__(self):
+            self.l = []
+
+        def a(self, name, delay=0.1):
+            time.sleep(delay)
+            self.l.append(name)
+
+        def fail(self):
+            time.sleep(0.05)
+            raise RuntimeError('fail')
+    t = Toto()
+    start = time.time()
+    t.run_sequence((Step('x', 'a', ('x',)), Step('y', 'a', ('y',)), Step('z', 'a', ('z', 0), after=('x', 'y'))))
+    assert time.time() - start < 0.2
+    assert sorted(t.l[:2]) == ['x', 'y']
+    assert t.l[2] == 'z'
+    assert set(t.timings) == {'x', 'y', 'z'}
+    assert t.timings['x'] >= 0.1
+    # a failure stops scheduling, running steps are finished
+    t = Toto()
+    with pytest.raises(RuntimeError):
+        t.run_steps((Step('slow', 'a', ('slow', 0.2)), Step('fail'), Step('next', 'a', ('next',), after=('fail',)),
+                     Step('other', 'a', ('other', 0), after=('slow',))))
+    assert t.l == ['slow']
+    with pytest.raises(ValueError):
+        t.run_steps((Step('x', 'a', after=('y',)), Step('y', 'a', after=('x',))))
+    with pytest.raises(ValueError):
+        t.run_steps((Step('x', 'a', after=('unknown',)), ))
+    # callables and workers limit
+    l = []
+    t.run_steps([Step(i, lambda i=i: l.append(i)) for i in range(5)], workers=1)
+    assert l == range(5)
+    # plain steps mixed with Step instances are chained in their order
+    t = Toto()
+    t.run_sequence((('a', 'first', 0.1), Step('x', 'a', ('x', 0)), ('a', 'second', 0)))
+    assert t.l.index('first') < t.l.index('second')
+    assert set(t.l) == {'first', 'second', 'x'}
+    # the traceback of the failed step is kept
+    with pytest.raises(RuntimeError) as e:
+        t.run_steps((Step('fail'), ))
+    assert e.traceback[-1].name == 'fail'
@@ -1,14 +1,30 @@
 # encoding: utf-8
 
+from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
 import cStringIO
+import errno
+import fcntl
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
 import os.path
+import Queue
+import re
+import shutil
 from subprocess import Popen, PIPE, call
 import sys
 import threading
+import time
+import uuid
 
 ROOTDIR = os.path.dirname(os.path.abspath(__file__))
 
+# size of the chunks used when streaming data through pipes
+CHUNK_SIZE = 64 * 1024
+# default number of threads used to run tasks concurrently
+PARALLEL_WORKERS = 8
+
 
 # ======================= GENERAL UTILILITIES =======================
 
@@ -61,8 +77,177 @@ def filter_column(text, column, start=0, sep=None, **kwargs):
     return values
 
 
+def parallel_map(func, iterable, workers=PARALLEL_WORKERS):
+    """ Like map, but func is applied concurrently in a pool of threads
+    :param func: a function taking one argument
+    :param iterable: the arguments
+    :param workers: maximum number of threads
+    :return: a list of results, in the order of iterable. The first exception raised by func, if any,
+             is raised again.
+    """
+    items = list(iterable)
+    if workers < 2 or len(items) < 2:
+        return map(func, items)
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+class QueryCache(object):
+    """ A thread safe memoization cache, with time to live and LRU eviction.
+        Entries are grouped by scope, so that all the entries of a scope can be invalidated at once.
+    """
+
+    def __init__(self, ttl=60, maxsize=256):
+        """
+        :param ttl: time to live of the entries, in seconds
+        :param maxsize: maximum number of entries, the least recently used are evicted first
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.generations = defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scope, key, func):
+        """ Returns the cached value of (scope, key), or calls func() to compute and cache it
+        """
+        key = (scope, key)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generations[scope]
+        value = func()
+        with self.lock:
+            # don't cache a value computed while its scope was invalidated
+            if generation == self.generations[scope]:
+                self.entries[key] = (time.time(), value)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, scope=None):
+        """ Removes the entries of a scope, or all entries if scope is None
+        """
+        with self.lock:
+            if scope is None:
+                for scope in self.generations:
+                    self.generations[scope] += 1
+                self.entries.clear()
+            else:
+                self.generations[scope] += 1
+                for key in [k for k in self.entries if k[0] == scope]:
+                    del self.entries[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class UsageRegistry(object):
+    """ Records the last use time of named objects in a json file,
+        safe to use from concurrent threads and processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        """ Context manager yielding the registry content as a dict name: timestamp, saved at exit
+        """
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with self.lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    try:
+                        with open(self.path) as f:
+                            usage = json.load(f)
+                    except (IOError, ValueError):
+                        usage = {}
+                    yield usage
+                    tmp = '{}.{}'.format(self.path, os.getpid())
+                    with open(tmp, 'w') as f:
+                        json.dump(usage, f)
+                    os.rename(tmp, self.path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def touch(self, *names):
+        with self.locked() as usage:
+            now = time.time()
+            for name in names:
+                usage[name] = now
+
+    def refresh(self, *names):
+        """ Like touch, but only for the names already registered
+        """
+        with self.locked() as usage:
+            now = time.time()
+            for name in names:
+                if name in usage:
+                    usage[name] = now
+
+    def forget(self, *names):
+        with self.locked() as usage:
+            for name in names:
+                usage.pop(name, None)
+
+    def usage(self):
+        with self.locked() as usage:
+            return dict(usage)
+
+
+class Step(object):
+    """ A step of Sequencer.run_steps
+    """
+
+    def __init__(self, name, target=None, args=(), after=()):
+        """
+        :param name: the step name
+        :param target: a method name of the sequencer or a callable (defaults to name)
+        :param args: the arguments of target
+        :param after: the names of the steps this step depends on
+        """
+        self.name = name
+        self.target = target or name
+        self.args = tuple(args)
+        self.after = tuple(after)
+
+    def __repr__(self):
+        return 'Step({!r})'.format(self.name)
+
+
 class Sequencer(object):
     def run_sequence(self, args):
+        """ Runs steps in sequence. Each step is a method name, or a tuple (method name, *args).
+            If some steps are Step instances, all are run by run_steps, the other steps being chained
+            in their order.
+        """
+        if any(isinstance(arg, Step) for arg in args):
+            steps, previous = [], ()
+            for i, arg in enumerate(args):
+                if not isinstance(arg, Step):
+                    target, target_args = (arg, ()) if isinstance(arg, basestring) else (arg[0], arg[1:])
+                    arg = Step('{}:{}'.format(i, target), target, target_args, after=previous)
+                    previous = (arg.name, )
+                steps.append(arg)
+            return self.run_steps(steps)
         for arg in args:
             if isinstance(arg, basestring):
                 getattr(self, arg)()
@@ -70,6 +255,59 @@ class Sequencer(object):
                 getattr(self, arg[0])(*(arg[1:]))
         return self
 
+    def run_steps(self, steps, workers=PARALLEL_WORKERS):
+        """ Runs steps concurrently on a pool of threads, each step starting when the steps it depends on
+            are done. On failure, no new step is started, the running steps are waited for, and the first
+            exception is raised again.
+            The duration of each completed step is stored in the 'timings' dict attribute.
+        :param steps: an iterable of Step
+        :param workers: maximum number of concurrent steps
+        """
+        steps = list(steps)
+        pending = {step.name: step for step in steps}
+        if len(pending) != len(steps):
+            raise ValueError("Duplicate steps names")
+        for step in steps:
+            unknown = set(step.after).difference(pending)
+            if unknown:
+                raise ValueError("Step {} depends on unknown steps {}".format(step.name, sorted(unknown)))
+        self.timings = {}
+        done, running, error = set(), set(), None
+        completed = Queue.Queue()
+
+        def run(step):
+            start = time.time()
+            try:
+                target = getattr(self, step.target) if isinstance(step.target, basestring) else step.target
+                target(*step.args)
+                completed.put((step.name, None, time.time() - start))
+            except Exception:
+                completed.put((step.name, sys.exc_info(), time.time() - start))
+
+        while pending or running:
+            if error is None:
+                ready = [step for step in steps if step.name in pending and done.issuperset(step.after)]
+                for step in ready[:max(0, workers - len(running))]:
+                    del pending[step.name]
+                    running.add(step.name)
+                    t = threading.Thread(target=run, args=(step,))
+                    t.daemon = True
+                    t.start()
+            if not running:
+                if error is None:
+                    raise ValueError("Circular dependencies between steps {}".format(sorted(pending)))
+                break
+            name, e, duration = completed.get()
+            running.remove(name)
+            if e is None:
+                done.add(name)
+                self.timings[name] = duration
+            elif error is None:
+                error = e
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return self
+
 
 # ======================= OS RELATED UTILITIES =======================
 
@@ -103,27 +341,302 @@ def cd(folder):
 COMMAND_DEBUG = None
 # COMMAND_DEBUG = 'Debug: '
 
+# docker subcommands that load the daemon the most
+HEAVY_OPERATIONS = ('build', 'commit', 'run', 'create', 'save', 'load', 'pull', 'push')
+
+
+def operation_type(cmd):
+    """ Classifies a shell command
+    :return: 'heavy' or 'light' for a docker command (see HEAVY_OPERATIONS), None otherwise
+    """
+    match = re.search(r'\bdocker\s+(\w+)', cmd)
+    if not match:
+        return None
+    return 'heavy' if match.group(1) in HEAVY_OPERATIONS else 'light'
+
+
+class AdaptiveLimiter(object):
+    """ Limits the number of concurrent operations, adapting the limit to the observed latency (AIMD):
+        the limit increases by one every 'limit' operations completed within 'tolerance' times the
+        baseline latency, and is multiplied by 'decrease' when an operation is slower, at most once
+        per latency period.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, tolerance=2.0, decrease=0.5, smoothing=0.1):
+        """
+        :param initial, minimum, maximum: initial and bounds of the concurrency limit
+        :param tolerance: latency increase factor over the baseline, triggering a decrease
+        :param decrease: multiplicative decrease factor of the limit
+        :param smoothing: rate at which the baseline latency follows latencies greater than itself
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.baseline = None
+        self.last_decrease = 0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.count = 0
+        self.queued = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    @contextmanager
+    def slot(self):
+        """ Context manager waiting for an execution slot, then measuring the latency of the operation
+        """
+        start = time.time()
+        with self.cond:
+            if self.in_flight >= int(self.limit):
+                self.queued += 1
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            now = time.time()
+            self.count += 1
+            self.total_wait += now - start
+            self.max_wait = max(self.max_wait, now - start)
+        try:
+            yield
+        finally:
+            latency = time.time() - now
+            with self.cond:
+                self.in_flight -= 1
+                self.update(latency)
+                self.cond.notify_all()
+
+    def update(self, latency):
+        now = time.time()
+        if self.baseline is None:
+            self.baseline = latency
+        elif latency > self.baseline * self.tolerance:
+            if now - self.last_decrease > latency:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        if self.baseline is not None:
+            if latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += self.smoothing * (latency - self.baseline)
+
+    def stats(self):
+        with self.cond:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'count': self.count,
+                    'queued': self.queued, 'total_wait': self.total_wait, 'max_wait': self.max_wait,
+                    'mean_wait': self.total_wait / self.count if self.count else 0.}
+
+
+class Governor(object):
+    """ Governs the concurrency of docker commands, with separate adaptive limiters for
+        heavy and light operations (see operation_type).
+    """
+
+    def __init__(self, heavy=None, light=None):
+        self.limiters = {'heavy': heavy or AdaptiveLimiter(initial=2, maximum=8),
+                         'light': light or AdaptiveLimiter(initial=8, maximum=64)}
+
+    @contextmanager
+    def slot(self, cmd):
+        kind = operation_type(cmd)
+        if kind is None:
+            yield
+        else:
+            with self.limiters[kind].slot():
+                yield
+
+    def stats(self):
+        return {k: v.stats() for k, v in self.limiters.iteritems()}
+
+
+# global governor of the command layer, see set_governor
+governor = None
+
+
+def set_governor(gov=True):
+    """ Sets the global governor of Command, command, command_input and command_stream
+    :param gov: a Governor instance, or True for a default Governor, or None to remove the governor
+    :return: the governor
+    """
+    global governor
+    governor = Governor() if gov is True else gov
+    return governor
+
+
+@contextmanager
+def governed(cmd):
+    """ Context manager acquiring an execution slot for cmd from the global governor, if any
+    """
+    if governor is None:
+        yield
+    else:
+        with governor.slot(cmd):
+            yield
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """ Splits data in chunks
+    :param data: a byte string, a file-like object (file, mmap, ...) or an iterable of byte strings
+    :param chunk_size: maximum size of the chunks read from a string or a file-like object
+    :return: a generator of byte strings
+    """
+    if isinstance(data, basestring):
+        for i in xrange(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+    elif hasattr(data, 'read'):
+        for chunk in iter(lambda: data.read(chunk_size), ''):
+            yield chunk
+    else:
+        for chunk in data:
+            yield chunk
+
+
+def feed_input(stdin, datain, chunk_size=CHUNK_SIZE):
+    """ Writes datain (see iter_chunks) to the stdin pipe of a process, then closes it.
+        Stops silently if the process exits without reading all its input.
+    :return: the number of bytes written
+    """
+    size = 0
+    try:
+        for chunk in iter_chunks(datain, chunk_size):
+            stdin.write(chunk)
+            size += len(chunk)
+    except IOError as e:
+        # the command exited without reading all its input
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        stdin.close()
+    return size
+
+
+class Recorder(object):
+    """ Records the executed commands in a json lines file: command, stdin size, stdout, stderr,
+        return code and latency. Byte strings are stored latin-1 decoded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, cmd, stdin_size, stdout, stderr, returncode, latency):
+        entry = {'cmd': cmd, 'stdin_size': stdin_size, 'returncode': returncode, 'latency': latency,
+                 'stdout': None if stdout is None else stdout.decode('latin-1'),
+                 'stderr': None if stderr is None else stderr.decode('latin-1')}
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Replayer(object):
+    """ Serves the responses recorded by a Recorder instead of executing commands.
+        The responses of a command are served in their recorded order, the last one being repeated.
+    """
+
+    def __init__(self, path, scale=1.):
+        """
+        :param path: a file written by a Recorder
+        :param scale: factor applied to the recorded latencies (0 for no latency)
+        """
+        self.scale = scale
+        self.responses = defaultdict(list)
+        self.lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                for k in ('stdout', 'stderr'):
+                    if entry[k] is not None:
+                        entry[k] = entry[k].encode('latin-1')
+                self.responses[entry['cmd']].append(entry)
+
+    def replay(self, cmd, datain=None):
+        """ Consumes datain, waits for the scaled latency, then returns the recorded response of cmd
+        :return: a tuple (stdout, stderr, returncode), stdout and stderr are '' if not recorded
+        """
+        with self.lock:
+            responses = self.responses.get(cmd)
+            if not responses:
+                raise LookupError("No recorded response for <{}>".format(cmd))
+            entry = responses.pop(0) if len(responses) > 1 else responses[0]
+        if datain is not None:
+            for _ in iter_chunks(datain):
+                pass
+        if self.scale:
+            time.sleep(entry['latency'] * self.scale)
+        return entry['stdout'] or '', entry['stderr'] or '', entry['returncode']
+
+
+# record/replay backends of the command layer, see recording and replaying
+recorder = None
+replayer = None
+
+
+@contextmanager
+def recording(path):
+    """ Context manager recording all the commands executed by Command, command,
+        command_input and command_stream in file path (see Recorder)
+    """
+    global recorder
+    recorder = Recorder(path)
+    try:
+        yield recorder
+    finally:
+        recorder.close()
+        recorder = None
+
+
+@contextmanager
+def replaying(path, scale=1.):
+    """ Context manager replaying the commands recorded in file path instead of executing them
+        (see Replayer)
+    """
+    global replayer
+    replayer = Replayer(path, scale)
+    try:
+        yield replayer
+    finally:
+        replayer = None
+
 
 class Command(object):
-    """ Use this class if you want to wait and get shell command output
+    """ Use this class if you want to wait and get shell command output.
+        Optional datain is streamed to the command's stdin, see command_input.
     """
-    def __init__(self, cmd, show=COMMAND_DEBUG):
+    def __init__(self, cmd, show=COMMAND_DEBUG, datain=None):
         self.show = show
-        self.p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
         self.out_buf = cStringIO.StringIO()
         self.err_buff = cStringIO.StringIO()
-        t_out = threading.Thread(target=self.out_handler)
-        t_err = threading.Thread(target=self.err_handler)
-        t_out.start()
-        t_err.start()
-        self.p.wait()
-        t_out.join()
-        t_err.join()
+        if replayer is not None:
+            self.p = None
+            self.stdout, self.stderr, self.returncode = replayer.replay(cmd, datain)
+            return
+        start = time.time()
+        stdin_size = []
+        with governed(cmd):
+            self.p = Popen(cmd, shell=True, stdin=None if datain is None else PIPE, stdout=PIPE, stderr=PIPE)
+            threads = [threading.Thread(target=self.out_handler), threading.Thread(target=self.err_handler)]
+            if datain is not None:
+                threads.append(threading.Thread(target=lambda: stdin_size.append(feed_input(self.p.stdin, datain))))
+            for t in threads:
+                t.start()
+            self.p.wait()
+            for t in threads:
+                t.join()
         self.p.stdout.close()
         self.p.stderr.close()
         self.stdout = self.out_buf.getvalue()
         self.stderr = self.err_buff.getvalue()
         self.returncode = self.p.returncode
+        if recorder is not None:
+            recorder.record(cmd, sum(stdin_size), self.stdout, self.stderr, self.returncode, time.time() - start)
 
     def out_handler(self):
         for line in iter(self.p.stdout.readline, ''):
@@ -141,24 +654,167 @@ class Command(object):
         return extract_column(self.stdout, column, start)
 
 
+class ShellSession(object):
+    """ A persistent shell process executing commands one at a time, which saves a process
+        creation (e.g. a 'docker exec') per command. Each command runs in its own subshell,
+        with stdin redirected from /dev/null, and its outputs are framed by a unique marker.
+        This bypasses the governor and the record/replay backends.
+    """
+
+    def __init__(self, cmd='/bin/bash'):
+        self.cmd = cmd
+        self.marker = 'YADIO-' + uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self.queues = Queue.Queue(), Queue.Queue()
+        for f, q in zip((self.p.stdout, self.p.stderr), self.queues):
+            t = threading.Thread(target=self.reader, args=(f, q))
+            t.daemon = True
+            t.start()
+
+    @staticmethod
+    def reader(f, q):
+        for line in iter(f.readline, ''):
+            q.put(line)
+        q.put(None)
+
+    def alive(self):
+        return self.p.poll() is None
+
+    def execute(self, cmd):
+        """ Executes a command in the session
+        :return: a tuple (stdout, stderr, returncode)
+        """
+        script = '(\n{1}\n) </dev/null\nret=$?; echo; echo "{0}:$ret"; echo >&2; echo "{0}:" >&2\n'.\
+            format(self.marker, cmd)
+        with self.lock:
+            try:
+                self.p.stdin.write(script)
+                self.p.stdin.flush()
+            except IOError:
+                raise RuntimeError("Session <{}> has exited".format(self.cmd))
+            stdout, returncode = self.read(self.queues[0])
+            stderr, _ = self.read(self.queues[1])
+        return stdout, stderr, int(returncode)
+
+    def read(self, q):
+        lines = []
+        while True:
+            line = q.get()
+            if line is None:
+                raise RuntimeError("Session <{}> has exited".format(self.cmd))
+            if line.startswith(self.marker + ':'):
+                # remove the newline echoed before the marker
+                return ''.join(lines)[:-1], line[len(self.marker) + 1:].strip()
+            lines.append(line)
+
+    def close(self):
+        if self.alive():
+            self.p.stdin.close()
+            self.p.wait()
+
+
 def command(cmd, raises=False):
     """ Use this function if you only want the return code.
         You can't retrieve stdout nor stderr and it never raises
     """
-    ret = call(cmd, shell=True)
+    if replayer is not None:
+        ret = replayer.replay(cmd)[2]
+    else:
+        start = time.time()
+        with governed(cmd):
+            ret = call(cmd, shell=True)
+        if recorder is not None:
+            recorder.record(cmd, 0, None, None, ret, time.time() - start)
     if ret and raises:
         raise RuntimeError("Error while executing<{}>".format(cmd))
     return ret
 
 
-def command_input(cmd, datain, raises=False):
-    """ Use this if you want to send data to stdin
+def command_input(cmd, datain, raises=False, chunk_size=CHUNK_SIZE):
+    """ Use this if you want to send data to stdin.
+        datain is streamed to stdin chunk by chunk (see iter_chunks), so large files or iterators
+        are sent in constant memory: writing blocks while the command does not consume its input.
+        The command outputs are discarded (except when recording). If reading datain fails, the command is killed.
     """
-    p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    p.communicate(datain)
-    if p.returncode and raises:
+    if replayer is not None:
+        returncode = replayer.replay(cmd, datain)[2]
+    else:
+        start = time.time()
+        bufs = (cStringIO.StringIO(), cStringIO.StringIO()) if recorder is not None else ()
+        with open(os.devnull, 'w') as devnull, governed(cmd):
+            sink = PIPE if bufs else devnull
+            p = Popen(cmd, shell=True, stdin=PIPE, stdout=sink, stderr=sink)
+            threads = [threading.Thread(target=shutil.copyfileobj, args=(f, buf))
+                       for f, buf in zip((p.stdout, p.stderr), bufs)]
+            for t in threads:
+                t.start()
+            fed = False
+            try:
+                stdin_size = feed_input(p.stdin, datain, chunk_size)
+                fed = True
+            finally:
+                if not fed and p.poll() is None:
+                    p.kill()
+                p.wait()
+                for t in threads:
+                    t.join()
+                if bufs:
+                    p.stdout.close()
+                    p.stderr.close()
+        returncode = p.returncode
+        if bufs:
+            recorder.record(cmd, stdin_size, bufs[0].getvalue(), bufs[1].getvalue(), returncode, time.time() - start)
+    if returncode and raises:
         raise RuntimeError("Error while executing<{}>".format(cmd))
-    return p.returncode
+    return returncode
+
+
+def command_stream(cmd, chunk_size=CHUNK_SIZE, raises=False):
+    """ Use this generator if you want to read stdout chunk by chunk, in constant memory
+        (except when recording, as stdout is recorded).
+        If the generator is not exhausted, the command is killed.
+        The governor slot is only held until the first bytes are read, the consumer pace is not
+        part of the measured latency.
+    """
+    if replayer is not None:
+        stdout, stderr, returncode = replayer.replay(cmd)
+        for chunk in iter_chunks(stdout, chunk_size):
+            yield chunk
+    else:
+        start = time.time()
+        out_buf = cStringIO.StringIO() if recorder is not None else None
+        err_buf = cStringIO.StringIO()
+        with governed(cmd):
+            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+            t_err = threading.Thread(target=shutil.copyfileobj, args=(p.stderr, err_buf))
+            t_err.start()
+            # os.read returns as soon as some bytes are available, read until a full first chunk or EOF
+            first, data = '', True
+            while data and len(first) < chunk_size:
+                data = os.read(p.stdout.fileno(), chunk_size - len(first))
+                first += data
+        exhausted = False
+        try:
+            if first:
+                chunks = itertools.chain([first], iter(lambda: p.stdout.read(chunk_size), ''))
+                for chunk in chunks:
+                    if out_buf is not None:
+                        out_buf.write(chunk)
+                    yield chunk
+            exhausted = True
+        finally:
+            if not exhausted and p.poll() is None:
+                p.kill()
+            p.stdout.close()
+            p.wait()
+            t_err.join()
+            p.stderr.close()
+        stderr, returncode = err_buf.getvalue(), p.returncode
+        if out_buf is not None and recorder is not None:
+            recorder.record(cmd, 0, out_buf.getvalue(), stderr, returncode, time.time() - start)
+    if returncode and raises:
+        raise RuntimeError("Error while executing<{}>: {}".format(cmd, stderr.strip()))
 
 
 def ssh(cmd, host, user='root', raises=True):